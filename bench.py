@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import random
+import resource
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import bottopt
+
+BENCH_TOKEN = "42:bench"
+BENCH_ADMIN_ID = 1000
+BENCH_BOT_ID = 42
+
+current_label = contextvars.ContextVar("current_label", default="startup")
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.message_id = 0
+        self.calls = Counter()
+        self.errors = Counter()
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, chat_id: int, text: str) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"},
+            "text": text
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != "getMe" and random.random() < self.error_rate:
+            self.errors[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            })
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method == "getMe":
+            result = {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChatAdministrators":
+            result = [{"status": "creator", "user": self.user(BENCH_ADMIN_ID), "is_anonymous": False}]
+        elif method == "getChatMember":
+            result = {"status": "member", "user": self.user(int(params["user_id"]))}
+        elif method.startswith(("send", "edit")):
+            result = self.message(chat_id, params.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class CallCounter(BaseRequestMiddleware):
+    def __init__(self):
+        self.calls = defaultdict(Counter)
+
+    async def __call__(self, make_request, bot, method):
+        self.calls[current_label.get()][method.__api_method__] += 1
+        return await make_request(bot, method)
+
+
+class UpdateFactory:
+    def __init__(self, chats: int, users: int):
+        self.chats = [-1000000000000 - i for i in range(chats)]
+        self.users = users
+        self.update_id = 0
+        self.message_id = 0
+
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, chat_id: int, user_id: int, text: str | None = None, **extra) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": self.user(user_id),
+            **extra
+        }
+        if text is not None:
+            message["text"] = text
+        return {"update_id": self.update_id, "message": message}
+
+    def random_user(self) -> int:
+        return 2000 + random.randrange(self.users)
+
+    def setup(self) -> list[dict]:
+        updates = []
+        for chat_id in self.chats:
+            updates.append(self.message(chat_id, BENCH_ADMIN_ID, "/setrules Не спамить"))
+            updates.append(self.message(chat_id, BENCH_ADMIN_ID, "/setwelcome Привет, {user}! Добро пожаловать в {chat}"))
+        return updates
+
+    def commands(self, count: int) -> list[dict]:
+        commands = [
+            "/warn спам", "/warn реклама", "/unwarn", "/warns", "/ban спам 1h", "/mute флуд 30m",
+            "/unmute", "/kick", "/info", "/rules", "/help", "/active", "/clearwarns"
+        ]
+        updates = []
+        for _ in range(count):
+            chat_id = random.choice(self.chats)
+            user_id = self.random_user()
+            target = self.message(chat_id, user_id, "привет")
+            updates.append(target)
+            command = random.choice(commands)
+            if random.random() < 0.5:
+                name, _, rest = command.partition(" ")
+                updates.append(self.message(chat_id, BENCH_ADMIN_ID, f"{name} @user{user_id} {rest}".strip()))
+            else:
+                updates.append(self.message(chat_id, BENCH_ADMIN_ID, command, reply_to_message=target["message"]))
+        return updates
+
+    def joins(self, waves: int, size: int) -> list[dict]:
+        updates = []
+        for _ in range(waves):
+            chat_id = random.choice(self.chats)
+            for _ in range(size):
+                user_id = self.random_user()
+                updates.append(self.message(chat_id, user_id, new_chat_members=[self.user(user_id)]))
+        return updates
+
+    def flood(self, count: int, flooders: int) -> list[dict]:
+        senders = [(random.choice(self.chats), self.random_user()) for _ in range(flooders)]
+        updates = []
+        for _ in range(count):
+            chat_id, user_id = random.choice(senders)
+            updates.append(self.message(chat_id, user_id, "spam " * random.randint(1, 20)))
+        return updates
+
+
+def label_of(update: dict) -> str:
+    message = update.get("message") or {}
+    if message.get("new_chat_members"):
+        return "join"
+    text = message.get("text") or ""
+    if text.startswith("/"):
+        return text.split()[0]
+    return "message" if message else next((key for key in update if key != "update_id"), "unknown")
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def replay(bot: Bot, updates: list[dict], rate: float, latencies: dict):
+    async def feed(raw: dict):
+        label = label_of(raw)
+        current_label.set(label)
+        update = Update.model_validate(raw, context={"bot": bot})
+        started = time.perf_counter()
+        try:
+            await bottopt.dp.feed_update(bot, update)
+        except Exception as e:
+            print(f"Update error ({label}): {e}")
+        latencies[label].append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.perf_counter()
+    for i, raw in enumerate(updates):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(raw), context=contextvars.copy_context()))
+    await asyncio.gather(*tasks)
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def build_updates(args) -> list[dict]:
+    factory = UpdateFactory(args.chats, args.users)
+    updates = []
+    if args.scenario in ("commands", "mixed"):
+        updates += factory.commands(args.commands)
+    if args.scenario in ("joins", "mixed"):
+        updates += factory.joins(args.waves, args.wave_size)
+    if args.scenario in ("flood", "mixed"):
+        updates += factory.flood(args.messages, args.flooders)
+    if args.scenario == "mixed":
+        random.shuffle(updates)
+    return factory.setup() + updates
+
+
+def report(updates: int, elapsed: float, latencies: dict, counter: CallCounter, server: FakeBotAPI):
+    print(f"updates: {updates}  elapsed: {elapsed:.2f}s  throughput: {updates / elapsed:.1f} updates/s")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print()
+    print(f"{'update':<14}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'api/upd':>10}  calls")
+    for label in sorted(latencies, key=lambda key: -len(latencies[key])):
+        values = latencies[label]
+        calls = counter.calls.get(label, Counter())
+        per_update = sum(calls.values()) / len(values)
+        methods = ", ".join(f"{method}={count}" for method, count in calls.most_common())
+        print(
+            f"{label:<14}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}"
+            f"{percentile(values, 0.99) * 1000:>10.2f}{per_update:>10.2f}  {methods}"
+        )
+    print()
+    print(f"server calls: {sum(server.calls.values())}  injected 429: {sum(server.errors.values())}")
+
+
+async def run(args):
+    random.seed(args.seed)
+    server = FakeBotAPI(args.latency, args.error_rate, args.retry_after)
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    session = bottopt.TunedSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}"))
+    bot = Bot(token=BENCH_TOKEN, session=session)
+    counter = CallCounter()
+    session.middleware(bottopt.single_flight)
+    session.middleware(counter)
+    if args.rate_limit:
+        session.middleware(bottopt.send_scheduler)
+    bottopt.bot = bot
+    bottopt.db = bottopt.Database(bottopt.MemoryStorage())
+    bottopt.modlog = bottopt.ModLog(tempfile.mkdtemp(prefix="bench-modlog-"))
+    bottopt.WELCOME_BATCH_WINDOW = args.welcome_window
+    bottopt.join_aggregator.window = args.welcome_window
+    bottopt.setup_dispatcher()
+    await bottopt.get_bot_user()
+
+    updates = load_updates(args.updates) if args.updates else build_updates(args)
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    await replay(bot, updates, args.rate, latencies)
+    elapsed = time.perf_counter() - started
+    await bottopt.action_executor.drain()
+    await asyncio.sleep(args.welcome_window + 0.1)
+    report(len(updates), elapsed, latencies, counter, server)
+    await session.close()
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay updates against a fake Bot API server")
+    parser.add_argument("--scenario", choices=["commands", "joins", "flood", "mixed"], default="mixed")
+    parser.add_argument("--updates", help="JSON lines file with recorded updates")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--waves", type=int, default=5)
+    parser.add_argument("--wave-size", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--flooders", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 = unthrottled")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--rate-limit", action="store_true", help="enable the outbound send scheduler")
+    parser.add_argument("--welcome-window", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
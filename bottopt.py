@@ -1,551 +1,3058 @@
-import asyncio
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import (
-    Message,
-    CallbackQuery,
-    InlineKeyboardMarkup,
-    InlineKeyboardButton,
-    ChatPermissions
-)
-from aiogram.filters import Command
-from aiogram.enums import ParseMode
-
-BOT_TOKEN = "1234567890"
-ADMIN_ID = 234567890
-
-bot = None
-dp = Dispatcher()
-router = Router()
-
-
-class Database:
-    def __init__(self):
-        self.global_admins = {ADMIN_ID}
-        self.warns = {}
-        self.rules = {}
-        self.welcome = {}
-
-db = Database()
-
-
-def parse_duration(text: str) -> timedelta | None:
-    if not text:
-        return None
-    text = text.lower().strip()
-    try:
-        if text.endswith(("m", "м")):
-            return timedelta(minutes=int(text[:-1]))
-        elif text.endswith(("h", "ч")):
-            return timedelta(hours=int(text[:-1]))
-        elif text.endswith(("d", "д")):
-            return timedelta(days=int(text[:-1]))
-        elif text.endswith(("w", "н")):
-            return timedelta(weeks=int(text[:-1]))
-        elif text.isdigit():
-            return timedelta(minutes=int(text))
-    except ValueError:
-        pass
-    return None
-
-
-def format_duration(td: timedelta) -> str:
-    total_seconds = int(td.total_seconds())
-    if total_seconds < 3600:
-        return f"{total_seconds // 60} мин"
-    elif total_seconds < 86400:
-        return f"{total_seconds // 3600} ч"
-    else:
-        return f"{total_seconds // 86400} д"
-
-
-def format_user(user) -> str:
-    if user.username:
-        return f"{user.first_name} (@{user.username})"
-    return f"{user.first_name} [ID: {user.id}]"
-
-
-def get_warns_key(chat_id: int, user_id: int) -> str:
-    return f"{chat_id}:{user_id}"
-
-
-def get_warns(chat_id: int, user_id: int) -> int:
-    return db.warns.get(get_warns_key(chat_id, user_id), 0)
-
-
-def add_warn(chat_id: int, user_id: int) -> int:
-    key = get_warns_key(chat_id, user_id)
-    db.warns[key] = db.warns.get(key, 0) + 1
-    return db.warns[key]
-
-
-def remove_warn(chat_id: int, user_id: int) -> int:
-    key = get_warns_key(chat_id, user_id)
-    if key in db.warns and db.warns[key] > 0:
-        db.warns[key] -= 1
-    return db.warns.get(key, 0)
-
-
-def clear_warns(chat_id: int, user_id: int):
-    db.warns[get_warns_key(chat_id, user_id)] = 0
-
-
-async def is_admin(chat_id: int, user_id: int) -> bool:
-    if user_id in db.global_admins:
-        return True
-    try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in ["creator", "administrator"]
-    except:
-        return False
-
-
-async def can_restrict(chat_id: int, user_id: int) -> bool:
-    try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status not in ["creator", "administrator"]
-    except:
-        return True
-
-
-async def get_target_user(message: Message, args: list):
-    if message.reply_to_message:
-        return message.reply_to_message.from_user, 1
-    if len(args) < 2:
-        return None, 0
-    identifier = args[1].strip()
-    if identifier.startswith("@"):
-        identifier = identifier[1:]
-    try:
-        user_id = int(identifier)
-        try:
-            member = await bot.get_chat_member(message.chat.id, user_id)
-            return member.user, 2
-        except:
-            return None, 0
-    except ValueError:
-        pass
-    return None, 0
-
-
-@router.message(Command("start"))
-async def cmd_start(message: Message):
-    if message.chat.type == "private":
-        await message.answer(
-            "👨‍💼 <b>Бот модерации чатов</b>\n\n"
-            "Добавьте меня в чат и дайте права администратора.\n\n"
-            "<b>Команды:</b>\n"
-            "/ban @user причина время\n"
-            "/mute @user причина время\n"
-            "/warn @user причина\n"
-            "/kick @user\n\n"
-            "<b>Время:</b> 10m, 2h, 1d, 1w\n\n"
-            "Можно отвечать на сообщение вместо @user",
-            parse_mode=ParseMode.HTML
-        )
-
-
-@router.message(Command("help"))
-async def cmd_help(message: Message):
-    await message.reply(
-        "📋 <b>Команды модерации</b>\n\n"
-        "<b>Баны:</b>\n"
-        "/ban причина время - ответом на сообщение\n"
-        "/ban @user причина время\n"
-        "/ban ID причина время\n"
-        "/unban @user или ID\n\n"
-        "<b>Муты:</b>\n"
-        "/mute причина время - ответом\n"
-        "/mute @user причина время\n"
-        "/unmute @user\n\n"
-        "<b>Варны:</b>\n"
-        "/warn причина - ответом\n"
-        "/warn @user причина\n"
-        "/unwarn @user\n"
-        "/clearwarns @user\n"
-        "/warns @user\n\n"
-        "<b>Другое:</b>\n"
-        "/kick - ответом или @user\n"
-        "/info - ответом или @user\n\n"
-        "<b>Время:</b>\n"
-        "30m = 30 минут\n"
-        "2h = 2 часа\n"
-        "1d = 1 день\n"
-        "1w = 1 неделя",
-        parse_mode=ParseMode.HTML
-    )
-
-
-@router.message(Command("ban"))
-async def cmd_ban(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, arg_offset = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply(
-            "❌ <b>Пользователь не найден</b>\n\n"
-            "Использование:\n"
-            "• Ответьте на сообщение: /ban причина время\n"
-            "• Или: /ban @username причина время\n"
-            "• Или: /ban ID причина время",
-            parse_mode=ParseMode.HTML
-        )
-    if not await can_restrict(message.chat.id, target_user.id):
-        return await message.reply("❌ Нельзя забанить администратора")
-    reason = "Не указана"
-    duration = None
-    if arg_offset == 1:
-        if len(args) >= 2:
-            reason = args[1]
-        if len(args) >= 3:
-            duration = parse_duration(args[2])
-    else:
-        if len(args) >= 3:
-            reason = args[2]
-        if len(args) >= 4:
-            duration = parse_duration(args[3])
-    try:
-        until_date = datetime.now() + duration if duration else None
-        await bot.ban_chat_member(message.chat.id, target_user.id, until_date=until_date)
-        duration_text = format_duration(duration) if duration else "навсегда"
-        await message.reply(
-            f"🚫 <b>Пользователь забанен</b>\n\n"
-            f"👤 {format_user(target_user)}\n"
-            f"📝 Причина: {reason}\n"
-            f"⏱ Срок: {duration_text}",
-            parse_mode=ParseMode.HTML
-        )
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("unban"))
-async def cmd_unban(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    if len(args) < 2:
-        return await message.reply("❌ Использование: /unban @user или /unban ID")
-    identifier = args[1].replace("@", "")
-    try:
-        user_id = int(identifier)
-    except ValueError:
-        return await message.reply("❌ Укажите ID пользователя числом")
-    try:
-        await bot.unban_chat_member(message.chat.id, user_id, only_if_banned=True)
-        await message.reply(f"✅ Пользователь {user_id} разбанен")
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("mute"))
-async def cmd_mute(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, arg_offset = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply(
-            "❌ <b>Пользователь не найден</b>\n\n"
-            "Использование:\n"
-            "• Ответьте на сообщение: /mute причина время\n"
-            "• Или: /mute @username причина время\n"
-            "• Или: /mute ID причина время",
-            parse_mode=ParseMode.HTML
-        )
-    if not await can_restrict(message.chat.id, target_user.id):
-        return await message.reply("❌ Нельзя замутить администратора")
-    reason = "Не указана"
-    duration = timedelta(hours=1)
-    if arg_offset == 1:
-        if len(args) >= 2:
-            reason = args[1]
-        if len(args) >= 3:
-            parsed = parse_duration(args[2])
-            if parsed:
-                duration = parsed
-    else:
-        if len(args) >= 3:
-            reason = args[2]
-        if len(args) >= 4:
-            parsed = parse_duration(args[3])
-            if parsed:
-                duration = parsed
-    try:
-        until_date = datetime.now() + duration
-        permissions = ChatPermissions(
-            can_send_messages=False,
-            can_send_media_messages=False,
-            can_send_other_messages=False,
-            can_add_web_page_previews=False
-        )
-        await bot.restrict_chat_member(message.chat.id, target_user.id, permissions=permissions, until_date=until_date)
-        await message.reply(
-            f"🔇 <b>Пользователь замучен</b>\n\n"
-            f"👤 {format_user(target_user)}\n"
-            f"📝 Причина: {reason}\n"
-            f"⏱ Срок: {format_duration(duration)}",
-            parse_mode=ParseMode.HTML
-        )
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("unmute"))
-async def cmd_unmute(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply("❌ Ответьте на сообщение или укажите @user/ID")
-    try:
-        permissions = ChatPermissions(
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-            can_send_polls=True,
-            can_invite_users=True
-        )
-        await bot.restrict_chat_member(message.chat.id, target_user.id, permissions=permissions)
-        await message.reply(f"🔊 {format_user(target_user)} размучен", parse_mode=ParseMode.HTML)
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("warn"))
-async def cmd_warn(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, arg_offset = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply(
-            "❌ <b>Пользователь не найден</b>\n\n"
-            "Использование:\n"
-            "• Ответьте на сообщение: /warn причина\n"
-            "• Или: /warn @username причина",
-            parse_mode=ParseMode.HTML
-        )
-    if not await can_restrict(message.chat.id, target_user.id):
-        return await message.reply("❌ Нельзя дать варн администратору")
-    reason = "Не указана"
-    if arg_offset == 1 and len(args) >= 2:
-        reason = " ".join(args[1:])
-    elif arg_offset == 2 and len(args) >= 3:
-        reason = " ".join(args[2:])
-    warns = add_warn(message.chat.id, target_user.id)
-    if warns >= 3:
-        try:
-            await bot.ban_chat_member(message.chat.id, target_user.id)
-            clear_warns(message.chat.id, target_user.id)
-            await message.reply(
-                f"🚫 <b>Пользователь забанен</b>\n\n"
-                f"👤 {format_user(target_user)}\n"
-                f"📝 Причина: 3/3 предупреждений",
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            await message.reply(f"❌ Ошибка бана: {e}")
-    else:
-        await message.reply(
-            f"⚠️ <b>Предупреждение</b>\n\n"
-            f"👤 {format_user(target_user)}\n"
-            f"📝 Причина: {reason}\n"
-            f"⚠️ Варнов: {warns}/3",
-            parse_mode=ParseMode.HTML
-        )
-
-
-@router.message(Command("unwarn"))
-async def cmd_unwarn(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply("❌ Ответьте на сообщение или укажите @user/ID")
-    warns = remove_warn(message.chat.id, target_user.id)
-    await message.reply(
-        f"✅ Варн снят\n\n👤 {format_user(target_user)}\n⚠️ Осталось: {warns}/3",
-        parse_mode=ParseMode.HTML
-    )
-
-
-@router.message(Command("clearwarns"))
-async def cmd_clearwarns(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply("❌ Ответьте на сообщение или укажите @user/ID")
-    clear_warns(message.chat.id, target_user.id)
-    await message.reply(f"✅ Все варны сняты с {format_user(target_user)}", parse_mode=ParseMode.HTML)
-
-
-@router.message(Command("warns"))
-async def cmd_warns(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        target_user = message.from_user
-    warns = get_warns(message.chat.id, target_user.id)
-    await message.reply(f"⚠️ У {format_user(target_user)} варнов: {warns}/3", parse_mode=ParseMode.HTML)
-
-
-@router.message(Command("kick"))
-async def cmd_kick(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        return await message.reply("❌ Ответьте на сообщение или укажите @user/ID")
-    if not await can_restrict(message.chat.id, target_user.id):
-        return await message.reply("❌ Нельзя кикнуть администратора")
-    try:
-        await bot.ban_chat_member(message.chat.id, target_user.id)
-        await bot.unban_chat_member(message.chat.id, target_user.id, only_if_banned=True)
-        await message.reply(f"👢 {format_user(target_user)} кикнут", parse_mode=ParseMode.HTML)
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("info"))
-async def cmd_info(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    args = message.text.split()
-    target_user, _ = await get_target_user(message, args)
-    if not target_user:
-        target_user = message.from_user
-    try:
-        member = await bot.get_chat_member(message.chat.id, target_user.id)
-        status_map = {
-            "creator": "👑 Создатель",
-            "administrator": "👨‍💼 Админ",
-            "member": "👤 Участник",
-            "restricted": "🔇 Ограничен",
-            "left": "🚪 Покинул",
-            "kicked": "🚫 Забанен"
-        }
-        status = status_map.get(member.status, member.status)
-        warns = get_warns(message.chat.id, target_user.id)
-        username_text = f"@{target_user.username}" if target_user.username else "нет"
-        await message.reply(
-            f"👤 <b>Информация</b>\n\n"
-            f"🆔 ID: <code>{target_user.id}</code>\n"
-            f"📛 Имя: {target_user.first_name}\n"
-            f"👤 Username: {username_text}\n"
-            f"📊 Статус: {status}\n"
-            f"⚠️ Варнов: {warns}/3",
-            parse_mode=ParseMode.HTML
-        )
-    except Exception as e:
-        await message.reply(f"❌ Ошибка: {e}")
-
-
-@router.message(Command("setrules"))
-async def cmd_setrules(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        return await message.reply("❌ Использование: /setrules текст правил")
-    db.rules[message.chat.id] = args[1]
-    await message.reply("✅ Правила установлены")
-
-
-@router.message(Command("rules"))
-async def cmd_rules(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    rules = db.rules.get(message.chat.id, "Правила не установлены")
-    await message.reply(f"📜 <b>Правила чата</b>\n\n{rules}", parse_mode=ParseMode.HTML)
-
-
-@router.message(Command("setwelcome"))
-async def cmd_setwelcome(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        return await message.reply("❌ Использование: /setwelcome текст\n\n{user} - имя\n{chat} - название чата")
-    db.welcome[message.chat.id] = args[1]
-    await message.reply("✅ Приветствие установлено")
-
-
-@router.message(Command("delwelcome"))
-async def cmd_delwelcome(message: Message):
-    if message.chat.type == "private":
-        return await message.reply("❌ Команда работает только в чатах")
-    if not await is_admin(message.chat.id, message.from_user.id):
-        return await message.reply("⛔ Нужны права администратора")
-    db.welcome.pop(message.chat.id, None)
-    await message.reply("✅ Приветствие удалено")
-
-
-@router.message(F.new_chat_members)
-async def on_new_member(message: Message):
-    for user in message.new_chat_members:
-        if user.id == (await bot.get_me()).id:
-            await message.reply(
-                "👋 <b>Привет! Я бот модерации.</b>\n\n"
-                "Дайте мне права администратора.\n"
-                "Команды: /help",
-                parse_mode=ParseMode.HTML
-            )
-        else:
-            welcome = db.welcome.get(message.chat.id)
-            if welcome:
-                text = welcome.replace("{user}", user.first_name).replace("{chat}", message.chat.title or "чат")
-                await message.reply(text, parse_mode=ParseMode.HTML)
-
-
-async def main():
-    global bot
-    bot = Bot(token=BOT_TOKEN)
-    dp.include_router(router)
-    print("Бот запускается....")
-    while True:
-        try:
-            await bot.delete_webhook(drop_pending_updates=True)
-            me = await bot.get_me()
-            print(f"Бот @{me.username} запущен!")
-            await dp.start_polling(bot)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            print(f"Error: {e}")
-            await asyncio.sleep(10)
-    await bot.session.close()
-
-
-if __name__ == "__main__":
-
-    asyncio.run(main())
+import time
+STARTED_AT = time.monotonic()  # before the other imports so startup time covers them
+
+import asyncio
+import bisect
+import heapq
+import hmac
+import html
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from datetime import datetime, timedelta
+
+from aiohttp import web
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.types import (
+    Update,
+    User,
+    Message,
+    CallbackQuery,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    ChatPermissions,
+    ChatMemberUpdated,
+    ReplyParameters
+)
+from aiogram.filters import Command
+from aiogram.dispatcher.flags import get_flag
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+
+BOT_TOKEN = "1234567890"
+BOT_API_URL = ""
+ADMIN_ID = 234567890
+ADMIN_CACHE_TTL = 300
+DB_PATH = "bot.db"
+DB_FLUSH_INTERVAL = 1.0
+WARN_EXPIRY = 30 * 86400
+WARN_WHEEL_RESOLUTION = 60
+SEND_CHAT_RATE = 20 / 60
+SEND_CHAT_BURST = 5
+SEND_GLOBAL_RATE = 30
+SEND_MAX_RETRIES = 3
+SEND_MAX_CHAT_BUCKETS = 10000
+UPDATE_MODE = "polling"
+WEBHOOK_URL = ""
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = ""
+WEBHOOK_QUEUE_SIZE = 1000
+UPDATE_WORKERS = 64
+WELCOME_BATCH_WINDOW = 3.0
+WELCOME_BATCH_CAP = 30
+USERNAME_INDEX_SIZE = 200000
+USERNAME_INDEX_TTL = 7 * 86400
+RECENT_JOINS_SIZE = 2000
+RECENT_JOINS_TTL = 86400
+BULK_MAX_TARGETS = 500
+BULK_CONCURRENCY = 10
+BULK_PROGRESS_INTERVAL = 2.0
+FLOOD_LIMIT = 10
+FLOOD_WINDOW = 5.0
+FLOOD_MUTE = timedelta(minutes=10)
+FLOOD_MAX_TRACKED = 100000
+ACTION_NOTIFY = True
+ACTIVE_LIST_LIMIT = 50
+RESPONSE_CACHE_TTL = 300
+RESPONSE_COOLDOWN = 30
+RESPONSE_CACHE_CHATS = 10000
+ESCALATION_DEFAULT = "3:ban"
+ESCALATION_MAX_WARNS = 20
+ESCALATION_ACTIONS = ("mute", "ban", "kick")
+ACTION_CONCURRENCY = 20
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9090
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SLOW_HANDLER = 0.0
+SHARDS = 1
+SHARD_QUEUE_SIZE = 10000
+SHARD_CHECK_INTERVAL = 1.0
+POLLING_TIMEOUT = 30
+POLLING_LIMIT = 100
+POLLING_MAX_INFLIGHT = 10000
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 30.0
+HTTP_POOL_SIZE = 100
+HTTP_POOL_PER_HOST = 0
+HTTP_KEEPALIVE = 30
+HTTP_DNS_TTL = 300
+HTTP_TIMEOUT = 30
+HTTP_METHOD_TIMEOUTS = {
+    "getMe": 5,
+    "getChatMember": 5,
+    "getChatAdministrators": 5,
+    "banChatMember": 10,
+    "unbanChatMember": 10,
+    "restrictChatMember": 10,
+    "sendMessage": 10,
+    "editMessageText": 10
+}
+MODLOG_DIR = "modlog"
+MODLOG_SEGMENT_SIZE = 64 * 1024 * 1024
+MODLOG_FLUSH_INTERVAL = 1.0
+MODLOG_QUERY_LIMIT = 20
+FEDBAN_BLOOM_BITS = 10
+FEDBAN_BLOOM_HASHES = 7
+FEDBAN_BLOOM_MIN = 1024
+FEDBAN_MERGE_SIZE = 10000
+FEDBAN_SYNC_INTERVAL = 2.0
+STARTUP_TARGET = 15.0
+WARMUP_RATE = 5
+WARMUP_CONCURRENCY = 4
+WARMUP_MAX_CHATS = 2000
+SINGLE_FLIGHT_METHODS = {"getMe", "getChatMember", "getChatAdministrators"}
+ADMIN_STATUSES = ("creator", "administrator")
+MODERATION_METHODS = {"banChatMember", "unbanChatMember", "restrictChatMember", "deleteMessage"}
+UNSCHEDULED_METHODS = {"getUpdates", "deleteWebhook", "setWebhook", "close", "logOut"}
+
+bot = None
+bot_user = None
+shard = None
+dp = Dispatcher()
+router = Router()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = Counter()
+        self.gauges = {}
+
+    def observe(self, name: str, value: float, **labels):
+        self.histograms[name, tuple(labels.items())].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[name, tuple(labels.items())] += value
+
+    def gauge(self, name: str, collect):
+        self.gauges[name] = collect
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, collect in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                lines.append(f"{name}{format_labels(tuple(labels.items()))} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            total = 0
+            for bound, count in zip(METRICS_BUCKETS + ("+Inf",), histogram.counts):
+                total += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain")
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        return web.Response(status=200 if startup.ready else 503)
+
+    async def serve(self, port: int | None = None):
+        port = port or METRICS_PORT
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        app.router.add_get("/ready", self.handle_ready)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        print(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+
+
+def profile_slow_handler(name: str, task: asyncio.Task):
+    print(f"Slow handler {name} (> {PROFILE_SLOW_HANDLER}s):")
+    task.print_stack()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data: dict):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        watchdog = None
+        if PROFILE_SLOW_HANDLER:
+            watchdog = asyncio.get_running_loop().call_later(
+                PROFILE_SLOW_HANDLER, profile_slow_handler, name, asyncio.current_task()
+            )
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+            if startup.first_update is None:
+                startup.update_handled()
+
+
+class APIMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            status = "retry_after"
+            raise
+        except TelegramAPIError:
+            status = "error"
+            raise
+        except Exception:
+            status = "network"
+            raise
+        finally:
+            metrics.inc("bot_api_requests_total", method=name, status=status)
+            if name != "getUpdates":
+                metrics.observe("bot_api_seconds", time.perf_counter() - started, method=name)
+
+api_metrics = APIMetricsMiddleware()
+
+
+class TimerWheel:
+    def __init__(self, resolution: float, callback):
+        self.resolution = resolution
+        self.callback = callback
+        self.slots = {}
+        self.current = None
+        self.task = None
+
+    def schedule(self, deadline: float, item):
+        if self.current is None:
+            self.current = int(time.time() // self.resolution)
+        slot = max(int(deadline // self.resolution), self.current + 1)
+        self.slots.setdefault(slot, []).append(item)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def cancel(self, deadline: float, item):
+        slot = int(deadline // self.resolution)
+        items = self.slots.get(slot)
+        if items and item in items:
+            items.remove(item)
+            if not items:
+                del self.slots[slot]
+
+    async def run(self):
+        while self.slots:
+            await asyncio.sleep(self.resolution - time.time() % self.resolution)
+            now = int(time.time() // self.resolution)
+            if now - self.current <= len(self.slots):
+                due = range(self.current + 1, now + 1)
+            else:
+                due = sorted(slot for slot in self.slots if slot <= now)
+            self.current = now
+            for slot in due:
+                for item in self.slots.pop(slot, ()):
+                    try:
+                        self.callback(item)
+                    except Exception as e:
+                        print(f"Timer error: {e}")
+
+
+class WarnStore:
+    def __init__(self, expiry: float = WARN_EXPIRY, on_change=None):
+        self.chats = {}
+        self.expiry = expiry
+        self.on_change = on_change
+        self.wheel = TimerWheel(WARN_WHEEL_RESOLUTION, self.expire)
+
+    def get(self, chat_id: int, user_id: int) -> int:
+        users = self.chats.get(chat_id)
+        if users is None:
+            return 0
+        record = users.get(user_id)
+        return record[0] if record else 0
+
+    def add(self, chat_id: int, user_id: int) -> int:
+        users = self.chats.setdefault(chat_id, {})
+        record = users.get(user_id)
+        if record is None:
+            record = users[user_id] = [0, []]
+        record[0] += 1
+        if self.expiry:
+            deadline = int(time.time() + self.expiry)
+            record[1].append(deadline)
+            self.wheel.schedule(deadline, (chat_id, user_id))
+        self.changed(chat_id, user_id, record)
+        return record[0]
+
+    def remove(self, chat_id: int, user_id: int) -> int:
+        record = self.chats.get(chat_id, {}).get(user_id)
+        if record is None:
+            return 0
+        record[0] -= 1
+        if record[0] <= 0:
+            self.clear(chat_id, user_id)
+            return 0
+        dropped = len(record[1]) - record[0]
+        for deadline in record[1][:dropped]:
+            self.wheel.cancel(deadline, (chat_id, user_id))
+        del record[1][:dropped]
+        self.changed(chat_id, user_id, record)
+        return record[0]
+
+    def clear(self, chat_id: int, user_id: int):
+        users = self.chats.get(chat_id)
+        record = users.pop(user_id, None) if users is not None else None
+        if record is None:
+            return
+        for deadline in record[1]:
+            self.wheel.cancel(deadline, (chat_id, user_id))
+        if not users:
+            del self.chats[chat_id]
+        self.changed(chat_id, user_id, None)
+
+    def load(self, chat_id: int, user_id: int, count: int, deadlines: list[int]):
+        users = self.chats.setdefault(chat_id, {})
+        if user_id in users:
+            return
+        record = users[user_id] = [count, deadlines if self.expiry else []]
+        for deadline in record[1]:
+            self.wheel.schedule(deadline, (chat_id, user_id))
+
+    def expire(self, item):
+        chat_id, user_id = item
+        record = self.chats.get(chat_id, {}).get(user_id)
+        if record is None:
+            return
+        cutoff = time.time() + self.wheel.resolution
+        deadlines = record[1]
+        expired = 0
+        while deadlines and deadlines[0] <= cutoff:
+            deadlines.pop(0)
+            expired += 1
+        if not expired:
+            return
+        record[0] = min(record[0], len(deadlines))
+        if record[0] == 0:
+            self.clear(chat_id, user_id)
+        else:
+            self.changed(chat_id, user_id, record)
+
+    def changed(self, chat_id: int, user_id: int, record: list | None):
+        if self.on_change:
+            self.on_change(chat_id, user_id, None if record is None else (record[0], list(record[1])))
+
+
+class MemoryStorage:
+    def load_chat(self, chat_id: int) -> dict:
+        return {"warns": {}, "rules": None, "welcome": None, "escalation": None}
+
+    def load_actions(self) -> list[tuple]:
+        return []
+
+    def load_state(self, key: str):
+        return None
+
+    def load_pending_updates(self) -> list[str]:
+        return []
+
+    def load_banlists(self) -> tuple[list, dict, list, int]:
+        return [], {}, [], 0
+
+    def load_banlist_changes(self, after: int) -> list[tuple]:
+        return []
+
+    def prune_banlist_changes(self, shards: int):
+        pass
+
+    def load_chat_ids(self) -> list[int]:
+        return []
+
+    def write(self, ops: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS warns ("
+                "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, count INTEGER NOT NULL, "
+                "deadlines TEXT NOT NULL DEFAULT '', "
+                "PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(warns)")}
+            if "deadlines" not in columns:
+                self.conn.execute("ALTER TABLE warns ADD COLUMN deadlines TEXT NOT NULL DEFAULT ''")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats ("
+                "chat_id INTEGER PRIMARY KEY, rules TEXT, welcome TEXT, escalation TEXT)"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chats)")}
+            if "escalation" not in columns:
+                self.conn.execute("ALTER TABLE chats ADD COLUMN escalation TEXT")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS actions ("
+                "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, reason TEXT NOT NULL DEFAULT '', "
+                "PRIMARY KEY (chat_id, user_id, kind)) WITHOUT ROWID"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS pending_updates (update_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS banlists (name TEXT PRIMARY KEY, owner INTEGER NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS banlist_entries ("
+                "name TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (name, user_id)) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS banlist_subs ("
+                "chat_id INTEGER NOT NULL, name TEXT NOT NULL, PRIMARY KEY (chat_id, name)) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS banlist_changes ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, name TEXT NOT NULL, user_id INTEGER NOT NULL)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def load_chat(self, chat_id: int) -> dict:
+        with self.lock:
+            conn = self.connect()
+            warns = {
+                user_id: (count, [int(d) for d in deadlines.split(",") if d])
+                for user_id, count, deadlines in conn.execute(
+                    "SELECT user_id, count, deadlines FROM warns WHERE chat_id = ?", (chat_id,)
+                )
+            }
+            row = conn.execute("SELECT rules, welcome, escalation FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        rules, welcome, escalation = row or (None, None, None)
+        return {"warns": warns, "rules": rules, "welcome": welcome, "escalation": escalation}
+
+    def load_actions(self) -> list[tuple]:
+        with self.lock:
+            conn = self.connect()
+            return conn.execute("SELECT chat_id, user_id, kind, expires_at, reason FROM actions").fetchall()
+
+    def load_state(self, key: str):
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def load_pending_updates(self) -> list[str]:
+        with self.lock:
+            rows = self.connect().execute("SELECT data FROM pending_updates ORDER BY update_id").fetchall()
+        return [row[0] for row in rows]
+
+    def load_chat_ids(self) -> list[int]:
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT chat_id FROM chats UNION SELECT chat_id FROM warns "
+                "UNION SELECT chat_id FROM actions UNION SELECT chat_id FROM banlist_subs"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def load_banlists(self) -> tuple[list, dict, list, int]:
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'banlist_changes'").fetchone()
+            seq = row[0] if row else 0
+            lists = conn.execute("SELECT name, owner FROM banlists").fetchall()
+            entries = {}
+            for name, user_id in conn.execute("SELECT name, user_id FROM banlist_entries ORDER BY name, user_id"):
+                entries.setdefault(name, array("q")).append(user_id)
+            subscriptions = conn.execute("SELECT chat_id, name FROM banlist_subs").fetchall()
+        return lists, entries, subscriptions, seq
+
+    def load_banlist_changes(self, after: int) -> list[tuple]:
+        with self.lock:
+            return self.connect().execute(
+                "SELECT seq, op, name, user_id FROM banlist_changes WHERE seq > ? ORDER BY seq", (after,)
+            ).fetchall()
+
+    def prune_banlist_changes(self, shards: int):
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                if shards <= 1:
+                    conn.execute("DELETE FROM banlist_changes")
+                    return
+                keys = [f"banlist_seq:{index}" for index in range(shards)]
+                rows = conn.execute(
+                    f"SELECT value FROM state WHERE key IN ({','.join('?' * shards)})", keys
+                ).fetchall()
+                if len(rows) == shards:
+                    conn.execute("DELETE FROM banlist_changes WHERE seq <= ?", (min(row[0] for row in rows),))
+
+    def write(self, ops: dict):
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                for key, value in ops.items():
+                    kind, chat_id = key[0], key[1]
+                    if kind == "warns":
+                        if value:
+                            conn.execute(
+                                "INSERT INTO warns (chat_id, user_id, count, deadlines) VALUES (?, ?, ?, ?) "
+                                "ON CONFLICT (chat_id, user_id) DO UPDATE "
+                                "SET count = excluded.count, deadlines = excluded.deadlines",
+                                (chat_id, key[2], value[0], ",".join(map(str, value[1])))
+                            )
+                        else:
+                            conn.execute("DELETE FROM warns WHERE chat_id = ? AND user_id = ?", (chat_id, key[2]))
+                    elif kind == "banlists":
+                        if value is None:
+                            conn.execute("DELETE FROM banlists WHERE name = ?", (key[1],))
+                        else:
+                            conn.execute("INSERT OR REPLACE INTO banlists (name, owner) VALUES (?, ?)", (key[1], value))
+                            conn.execute(
+                                "INSERT INTO banlist_changes (op, name, user_id) VALUES ('list', ?, ?)", (key[1], value)
+                            )
+                    elif kind == "banlist_entries":
+                        if value:
+                            conn.execute("INSERT OR IGNORE INTO banlist_entries (name, user_id) VALUES (?, ?)", key[1:])
+                        else:
+                            conn.execute("DELETE FROM banlist_entries WHERE name = ? AND user_id = ?", key[1:])
+                        conn.execute(
+                            "INSERT INTO banlist_changes (op, name, user_id) VALUES (?, ?, ?)",
+                            ("add" if value else "remove",) + key[1:]
+                        )
+                    elif kind == "banlist_subs":
+                        if value:
+                            conn.execute("INSERT OR IGNORE INTO banlist_subs (chat_id, name) VALUES (?, ?)", key[1:])
+                        else:
+                            conn.execute("DELETE FROM banlist_subs WHERE chat_id = ? AND name = ?", key[1:])
+                    elif kind == "pending_update":
+                        if value is None:
+                            conn.execute("DELETE FROM pending_updates WHERE update_id = ?", (key[1],))
+                        else:
+                            conn.execute("INSERT OR REPLACE INTO pending_updates (update_id, data) VALUES (?, ?)", (key[1], value))
+                    elif kind == "state":
+                        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key[1], value))
+                    elif kind == "actions":
+                        if value:
+                            conn.execute(
+                                "INSERT OR REPLACE INTO actions (chat_id, user_id, kind, expires_at, reason) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                (chat_id, key[2], key[3], value[0], value[1])
+                            )
+                        else:
+                            conn.execute(
+                                "DELETE FROM actions WHERE chat_id = ? AND user_id = ? AND kind = ?",
+                                (chat_id, key[2], key[3])
+                            )
+                    else:
+                        conn.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+                        conn.execute(f"UPDATE chats SET {kind} = ? WHERE chat_id = ?", (value, chat_id))
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class Database:
+    def __init__(self, storage=None):
+        self.global_admins = {ADMIN_ID}
+        self.warns = WarnStore(on_change=self.warns_changed)
+        self.rules = {}
+        self.welcome = {}
+        self.welcome_templates = {}
+        self.escalation = {}
+        self.storage = storage or MemoryStorage()
+        self.loaded = set()
+        self.loading = {}
+        self.pending = {}
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+
+    async def load_chat(self, chat_id: int):
+        if chat_id in self.loaded:
+            return
+        task = self.loading.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self.storage.load_chat, chat_id))
+            self.loading[chat_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(chat_id, None))
+        data = await asyncio.shield(task)
+        if chat_id in self.loaded:
+            return
+        for user_id, (count, deadlines) in data["warns"].items():
+            self.warns.load(chat_id, user_id, count, deadlines)
+        if data["rules"] is not None:
+            self.rules.setdefault(chat_id, data["rules"])
+        if data["welcome"] is not None and chat_id not in self.welcome:
+            self.welcome[chat_id] = data["welcome"]
+            self.welcome_templates[chat_id] = compile_template(data["welcome"])
+        if data["escalation"] is not None and chat_id not in self.escalation:
+            escalation = compile_escalation(data["escalation"])
+            if escalation is not None:
+                self.escalation[chat_id] = escalation
+        self.loaded.add(chat_id)
+
+    def warns_changed(self, chat_id: int, user_id: int, value: tuple | None):
+        response_cache.invalidate_user(chat_id, user_id)
+        self.schedule(("warns", chat_id, user_id), value)
+
+    def set_rules(self, chat_id: int, text: str):
+        self.rules[chat_id] = text
+        response_cache.discard(chat_id, ("rules",))
+        self.schedule(("rules", chat_id), text)
+
+    def set_welcome(self, chat_id: int, text: str | None):
+        if text is None:
+            self.welcome.pop(chat_id, None)
+            self.welcome_templates.pop(chat_id, None)
+        else:
+            self.welcome[chat_id] = text
+            self.welcome_templates[chat_id] = compile_template(text)
+        self.schedule(("welcome", chat_id), text)
+
+    def set_escalation(self, chat_id: int, escalation):
+        if escalation is None:
+            self.escalation.pop(chat_id, None)
+        else:
+            self.escalation[chat_id] = escalation
+        response_cache.invalidate_chat(chat_id)
+        self.schedule(("escalation", chat_id), escalation.source if escalation else None)
+
+    def escalation_for(self, chat_id: int):
+        return self.escalation.get(chat_id) or default_escalation
+
+    def schedule(self, key: tuple, value):
+        self.pending[key] = value
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self) -> bool:
+        async with self.flush_lock:
+            while self.pending:
+                ops, self.pending = self.pending, {}
+                try:
+                    await asyncio.to_thread(self.storage.write, ops)
+                except Exception as e:
+                    print(f"DB flush error: {e}")
+                    for key, value in ops.items():
+                        self.pending.setdefault(key, value)
+                    return False
+        return True
+
+    async def close(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self.flush()
+        await asyncio.to_thread(self.storage.close)
+
+db = Database(SQLiteStorage(DB_PATH) if DB_PATH else MemoryStorage())
+
+
+class ActionScheduler:
+    def __init__(self):
+        self.heap = []
+        self.chats = {}
+        self.count = 0
+        self.timer = None
+        self.deadline = None
+
+    async def load(self):
+        rows = await asyncio.to_thread(db.storage.load_actions)
+        now = time.time()
+        for chat_id, user_id, kind, expires, reason in rows:
+            if shard is not None and shard_of(chat_id) != shard:
+                continue
+            if expires <= now:
+                db.schedule(("actions", chat_id, user_id, kind), None)
+            else:
+                self.add(chat_id, user_id, kind, expires, reason, persist=False)
+
+    def add(self, chat_id: int, user_id: int, kind: str, expires: float, reason: str = "", persist: bool = True):
+        actions = self.chats.setdefault(chat_id, {})
+        if (user_id, kind) not in actions:
+            self.count += 1
+        actions[(user_id, kind)] = (expires, reason)
+        heapq.heappush(self.heap, (expires, chat_id, user_id, kind))
+        if persist:
+            db.schedule(("actions", chat_id, user_id, kind), (expires, reason))
+        self.arm()
+
+    def cancel(self, chat_id: int, user_id: int, kind: str) -> bool:
+        actions = self.chats.get(chat_id)
+        if actions is None or actions.pop((user_id, kind), None) is None:
+            return False
+        if not actions:
+            del self.chats[chat_id]
+        self.count -= 1
+        db.schedule(("actions", chat_id, user_id, kind), None)
+        if len(self.heap) > 2 * self.count + 64:
+            self.heap = [item for item in self.heap if self.live(item)]
+            heapq.heapify(self.heap)
+        return True
+
+    def active(self, chat_id: int) -> list[tuple]:
+        actions = self.chats.get(chat_id, {})
+        return sorted(
+            (expires, user_id, kind, reason) for (user_id, kind), (expires, reason) in actions.items()
+        )
+
+    def live(self, item: tuple) -> bool:
+        expires, chat_id, user_id, kind = item
+        entry = self.chats.get(chat_id, {}).get((user_id, kind))
+        return entry is not None and entry[0] == expires
+
+    def arm(self):
+        while self.heap and not self.live(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.deadline <= deadline:
+                return
+            self.timer.cancel()
+        self.deadline = deadline
+        self.timer = asyncio.get_running_loop().call_later(max(0.0, deadline - time.time()), self.fire)
+
+    def fire(self):
+        self.timer = None
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            expires, chat_id, user_id, kind = heapq.heappop(self.heap)
+            if self.live((expires, chat_id, user_id, kind)):
+                self.cancel(chat_id, user_id, kind)
+                if ACTION_NOTIFY:
+                    asyncio.ensure_future(self.notify(chat_id, user_id, kind))
+        self.arm()
+
+    async def notify(self, chat_id: int, user_id: int, kind: str):
+        title = "бана" if kind == "ban" else "мута"
+        try:
+            await bot.send_message(
+                chat_id,
+                f"⏱ Истёк срок {title}: <a href=\"tg://user?id={user_id}\">{user_id}</a>",
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            print(f"Notify error: {e}")
+
+timed_actions = ActionScheduler()
+
+
+class ModLog:
+    def __init__(self, path: str = MODLOG_DIR, segment_size: int = MODLOG_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.index = None
+        self.file = None
+        self.segment = 0
+        self.size = 0
+        self.readers = {}
+        self.pending = []
+        self.flush_task = None
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:08d}.log")
+
+    def segments(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".log") and name[:-4].isdigit())
+
+    def open(self):
+        if self.index is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(self.path, "index.db"), check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, "
+            "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, ts INTEGER NOT NULL, "
+            "PRIMARY KEY (segment, offset)) WITHOUT ROWID"
+        )
+        self.index.execute("CREATE INDEX IF NOT EXISTS entries_user ON entries (chat_id, user_id, ts)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS entries_time ON entries (chat_id, ts)")
+        self.recover()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.size = self.file.tell()
+
+    def recover(self):
+        row = self.index.execute(
+            "SELECT segment, offset + length FROM entries ORDER BY segment DESC, offset DESC LIMIT 1"
+        ).fetchone()
+        last_segment, position = row or (0, 0)
+        rows = []
+        for segment in self.segments():
+            if segment < last_segment:
+                continue
+            offset = position if segment == last_segment else 0
+            with open(self.segment_path(segment), "rb+") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        f.truncate(offset)
+                        break
+                    record = json.loads(line)
+                    rows.append((segment, offset, len(line), record["chat"], record["user"], record["ts"]))
+                    offset += len(line)
+        with self.index:
+            self.index.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def record(self, chat_id: int, user_id: int, admin_id: int | None, action: str, reason: str = "", duration: timedelta | None = None):
+        self.pending.append({
+            "ts": int(time.time()),
+            "chat": chat_id,
+            "user": user_id,
+            "admin": admin_id,
+            "action": action,
+            "reason": reason,
+            "duration": int(duration.total_seconds()) if duration else None
+        })
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(MODLOG_FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            records, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self.write, records)
+            except Exception as e:
+                print(f"Modlog flush error: {e}")
+                self.pending[:0] = records
+                return
+
+    def write(self, records: list[dict]):
+        with self.lock:
+            self.open()
+            rows = []
+            for record in records:
+                line = json.dumps(record, ensure_ascii=False).encode() + b"\n"
+                if self.size and self.size + len(line) > self.segment_size:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.file.close()
+                    self.segment += 1
+                    self.file = open(self.segment_path(self.segment), "ab")
+                    self.size = 0
+                self.file.write(line)
+                rows.append((self.segment, self.size, len(line), record["chat"], record["user"], record["ts"]))
+                self.size += len(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.index:
+                self.index.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def read(self, chat_id: int, user_id: int | None, limit: int) -> list[dict]:
+        with self.lock:
+            self.open()
+            if user_id is None:
+                rows = self.index.execute(
+                    "SELECT segment, offset, length FROM entries WHERE chat_id = ? "
+                    "ORDER BY ts DESC, segment DESC, offset DESC LIMIT ?",
+                    (chat_id, limit)
+                ).fetchall()
+            else:
+                rows = self.index.execute(
+                    "SELECT segment, offset, length FROM entries WHERE chat_id = ? AND user_id = ? "
+                    "ORDER BY ts DESC, segment DESC, offset DESC LIMIT ?",
+                    (chat_id, user_id, limit)
+                ).fetchall()
+            records = []
+            for segment, offset, length in rows:
+                reader = self.readers.get(segment)
+                if reader is None:
+                    reader = self.readers[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+                records.append(json.loads(os.pread(reader, length, offset)))
+            return records
+
+    async def query(self, chat_id: int, user_id: int | None = None, limit: int = MODLOG_QUERY_LIMIT) -> list[dict]:
+        recent = [
+            record for record in reversed(self.pending)
+            if record["chat"] == chat_id and (user_id is None or record["user"] == user_id)
+        ][:limit]
+        stored = await asyncio.to_thread(self.read, chat_id, user_id, limit - len(recent)) if len(recent) < limit else []
+        return recent + stored
+
+    async def close(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self.flush()
+        with self.lock:
+            for reader in self.readers.values():
+                os.close(reader)
+            self.readers = {}
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+
+modlog = ModLog()
+
+
+class BanList:
+    def __init__(self, name: str, owner: int, ids: array | None = None):
+        self.name = name
+        self.owner = owner
+        self.ids = ids if ids is not None else array("q")
+        self.extra = set()
+        self.removed = set()
+        self.build_bloom()
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.extra) - len(self.removed)
+
+    def build_bloom(self):
+        self.capacity = max(FEDBAN_BLOOM_MIN, 2 * len(self))
+        self.bits = self.capacity * FEDBAN_BLOOM_BITS
+        self.bloom = bytearray(self.bits // 8 + 1)
+        bloom = self.bloom
+        positions = self.positions
+        for user_id in itertools.chain(self.ids, self.extra):
+            for bit in positions(user_id):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+
+    def positions(self, user_id: int):
+        h = (user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = (h >> 32) | 1
+        bits = self.bits
+        return [(h + i * h2) % bits for i in range(FEDBAN_BLOOM_HASHES)]
+
+    def bloom_add(self, user_id: int):
+        for bit in self.positions(user_id):
+            self.bloom[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, user_id: int) -> bool:
+        bloom = self.bloom
+        for bit in self.positions(user_id):
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        if user_id in self.removed:
+            return False
+        if user_id in self.extra:
+            return True
+        i = bisect.bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def add(self, user_id: int) -> bool:
+        if user_id in self:
+            return False
+        if user_id in self.removed:
+            self.removed.discard(user_id)
+        else:
+            self.extra.add(user_id)
+        self.bloom_add(user_id)
+        if len(self.extra) > FEDBAN_MERGE_SIZE:
+            self.compact()
+        if len(self) > self.capacity:
+            self.build_bloom()
+        return True
+
+    def remove(self, user_id: int) -> bool:
+        if user_id not in self:
+            return False
+        if user_id in self.extra:
+            self.extra.discard(user_id)
+        else:
+            self.removed.add(user_id)
+            if len(self.removed) > FEDBAN_MERGE_SIZE:
+                self.compact()
+        return True
+
+    def compact(self):
+        ids = set(self.ids)
+        ids |= self.extra
+        ids -= self.removed
+        self.ids = array("q", sorted(ids))
+        self.extra = set()
+        self.removed = set()
+
+
+class FederatedBans:
+    def __init__(self, sync_interval: float = FEDBAN_SYNC_INTERVAL):
+        self.lists = {}
+        self.subscriptions = {}
+        self.sync_interval = sync_interval
+        self.seq = 0
+        self.sync_task = None
+
+    async def load(self):
+        self.lists, subscriptions, self.seq = await asyncio.to_thread(self.build)
+        for chat_id, name in subscriptions:
+            if name in self.lists:
+                self.subscriptions.setdefault(chat_id, set()).add(name)
+        if SHARDS > 1:
+            db.schedule(("state", f"banlist_seq:{shard}"), self.seq)
+            self.sync_task = asyncio.ensure_future(self.sync())
+        else:
+            await asyncio.to_thread(db.storage.prune_banlist_changes, SHARDS)
+
+    def build(self) -> tuple[dict, list, int]:
+        lists, entries, subscriptions, seq = db.storage.load_banlists()
+        return {name: BanList(name, owner, entries.get(name)) for name, owner in lists}, subscriptions, seq
+
+    async def sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                changes = await asyncio.to_thread(db.storage.load_banlist_changes, self.seq)
+                if shard == 0:
+                    await asyncio.to_thread(db.storage.prune_banlist_changes, SHARDS)
+            except Exception as e:
+                print(f"Ban list sync error: {e}")
+                continue
+            if changes:
+                db.schedule(("state", f"banlist_seq:{shard}"), changes[-1][0])
+            for seq, op, name, user_id in changes:
+                self.seq = seq
+                if op == "list":
+                    if name not in self.lists:
+                        self.lists[name] = BanList(name, user_id)
+                elif name in self.lists:
+                    if op == "add":
+                        self.lists[name].add(user_id)
+                    else:
+                        self.lists[name].remove(user_id)
+
+    def create(self, name: str, owner: int) -> bool:
+        if name in self.lists:
+            return False
+        self.lists[name] = BanList(name, owner)
+        db.schedule(("banlists", name), owner)
+        return True
+
+    def can_edit(self, name: str, user_id: int) -> bool:
+        banlist = self.lists.get(name)
+        return banlist is not None and (banlist.owner == user_id or user_id in db.global_admins)
+
+    def add(self, name: str, user_id: int) -> bool:
+        if not self.lists[name].add(user_id):
+            return False
+        db.schedule(("banlist_entries", name, user_id), True)
+        return True
+
+    def remove(self, name: str, user_id: int) -> bool:
+        if not self.lists[name].remove(user_id):
+            return False
+        db.schedule(("banlist_entries", name, user_id), None)
+        return True
+
+    def subscribe(self, chat_id: int, name: str):
+        self.subscriptions.setdefault(chat_id, set()).add(name)
+        db.schedule(("banlist_subs", chat_id, name), True)
+
+    def unsubscribe(self, chat_id: int, name: str) -> bool:
+        names = self.subscriptions.get(chat_id)
+        if not names or name not in names:
+            return False
+        names.discard(name)
+        if not names:
+            del self.subscriptions[chat_id]
+        db.schedule(("banlist_subs", chat_id, name), None)
+        return True
+
+    def match(self, chat_id: int, user_id: int) -> str | None:
+        for name in self.subscriptions.get(chat_id, ()):
+            if user_id in self.lists[name]:
+                return name
+        return None
+
+federated_bans = FederatedBans()
+
+
+class ChatLoadMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Message, data: dict):
+        if event.chat.type != "private":
+            await db.load_chat(event.chat.id)
+        return await handler(event, data)
+
+
+class UsernameIndex:
+    def __init__(self, size: int = USERNAME_INDEX_SIZE, ttl: float = USERNAME_INDEX_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, chat_id: int, user):
+        if not user.username:
+            return
+        key = (chat_id, user.username.lower())
+        entry = self.entries.get(key)
+        expires = time.monotonic() + self.ttl
+        if entry is not None and entry[0] == user.id and entry[1] == user.first_name:
+            entry[3] = expires
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = [user.id, user.first_name, user.username, expires]
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, chat_id: int, username: str) -> User | None:
+        key = (chat_id, username.lower())
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[3] < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return User(id=entry[0], is_bot=False, first_name=entry[1], username=entry[2])
+
+username_index = UsernameIndex()
+
+
+class UsernameIndexMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Message, data: dict):
+        chat_id = event.chat.id
+        if event.from_user:
+            username_index.add(chat_id, event.from_user)
+        if event.new_chat_members:
+            for user in event.new_chat_members:
+                username_index.add(chat_id, user)
+        if event.reply_to_message and event.reply_to_message.from_user:
+            username_index.add(chat_id, event.reply_to_message.from_user)
+        return await handler(event, data)
+
+
+class ChatExecutor(BaseMiddleware):
+    def __init__(self, workers: int = UPDATE_WORKERS):
+        self.semaphore = asyncio.Semaphore(workers)
+        self.queues = {}
+        self.processed = 0
+
+    async def __call__(self, handler, event: Update, data: dict):
+        chat = data.get("event_chat")
+        if chat is None:
+            async with self.semaphore:
+                return await handler(event, data)
+        entry = self.queues.get(chat.id)
+        if entry is None:
+            entry = self.queues[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        queued = time.perf_counter()
+        try:
+            async with entry[0]:
+                async with self.semaphore:
+                    metrics.observe("bot_update_wait_seconds", time.perf_counter() - queued)
+                    return await handler(event, data)
+        finally:
+            self.processed += 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.queues[chat.id]
+
+    def stats(self) -> dict:
+        depths = [entry[1] for entry in self.queues.values()]
+        return {
+            "active_chats": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "processed": self.processed
+        }
+
+update_executor = ChatExecutor()
+
+
+class AdminCache:
+    def __init__(self, ttl: float = ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self.chats = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id: int) -> set[int]:
+        entry = self.chats.get(chat_id)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        task = self.pending.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(chat_id))
+            self.pending[chat_id] = task
+            task.add_done_callback(lambda _: self.pending.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, chat_id: int) -> set[int]:
+        admins = await bot.get_chat_administrators(chat_id)
+        ids = {member.user.id for member in admins}
+        self.chats[chat_id] = (time.monotonic() + self.ttl, ids)
+        return ids
+
+    def update(self, chat_id: int, user_id: int, status: str):
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            return
+        if status in ADMIN_STATUSES:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+
+    def invalidate(self, chat_id: int):
+        self.chats.pop(chat_id, None)
+
+admin_cache = AdminCache()
+
+
+class CachedResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.created = time.monotonic()
+        self.message_id = None
+        self.sent_at = 0.0
+        self.pointed = False
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, cooldown: float = RESPONSE_COOLDOWN, max_chats: int = RESPONSE_CACHE_CHATS):
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.suppressed = 0
+
+    def get(self, chat_id: int, key: tuple) -> CachedResponse | None:
+        entries = self.chats.get(chat_id)
+        entry = entries.get(key) if entries else None
+        if entry is None or time.monotonic() - entry.created > self.ttl:
+            self.misses += 1
+            return None
+        self.chats.move_to_end(chat_id)
+        self.hits += 1
+        return entry
+
+    def put(self, chat_id: int, key: tuple, text: str) -> CachedResponse:
+        entries = self.chats.get(chat_id)
+        if entries is None:
+            entries = self.chats[chat_id] = {}
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        entry = entries[key] = CachedResponse(text)
+        return entry
+
+    def discard(self, chat_id: int, key: tuple):
+        entries = self.chats.get(chat_id)
+        if entries:
+            entries.pop(key, None)
+
+    def invalidate_chat(self, chat_id: int):
+        self.chats.pop(chat_id, None)
+
+    def invalidate_user(self, chat_id: int, user_id: int):
+        entries = self.chats.get(chat_id)
+        if entries:
+            entries.pop(("warns", user_id), None)
+            entries.pop(("info", user_id), None)
+
+    async def reply(self, message: Message, key: tuple, build):
+        chat_id = message.chat.id
+        entry = self.get(chat_id, key)
+        now = time.monotonic()
+        if entry is not None and entry.message_id and now - entry.sent_at < self.cooldown:
+            self.suppressed += 1
+            if not entry.pointed:
+                entry.pointed = True
+                await message.answer(
+                    "👆 Ответ выше",
+                    reply_parameters=ReplyParameters(message_id=entry.message_id, allow_sending_without_reply=True)
+                )
+            return
+        if entry is None:
+            entry = self.put(chat_id, key, await build())
+        sent = await message.reply(entry.text, parse_mode=ParseMode.HTML)
+        entry.message_id = sent.message_id
+        entry.sent_at = now
+        entry.pointed = False
+
+response_cache = ResponseCache()
+
+
+class Backoff:
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def reserve(self) -> float:
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self) -> float:
+        tokens = self.refill()
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def idle(self) -> bool:
+        return self.refill() >= self.capacity
+
+
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chats = {}
+        self.waiters = []
+        self.seq = itertools.count()
+        self.task = None
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= SEND_MAX_CHAT_BUCKETS:
+                self.chats = {key: value for key, value in self.chats.items() if not value.idle()}
+            bucket = self.chats[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    async def acquire(self, priority: int):
+        if not self.waiters and self.global_bucket.delay() == 0:
+            self.global_bucket.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        while self.waiters:
+            if self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+                continue
+            delay = self.global_bucket.delay()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            self.global_bucket.tokens -= 1
+            heapq.heappop(self.waiters)[2].set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if name in UNSCHEDULED_METHODS:
+            return await make_request(bot, method)
+        if name in MODERATION_METHODS:
+            priority = 0
+        elif name.startswith(("send", "edit")):
+            priority = 2
+        else:
+            priority = 1
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            if priority == 2 and isinstance(chat_id, int):
+                delay = self.chat_bucket(chat_id).reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            await self.acquire(priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+send_scheduler = SendScheduler()
+
+
+class ActionExecutor:
+    def __init__(self, concurrency: int = ACTION_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.chains = {}
+        self.tasks = set()
+
+    def submit(self, chat_id: int, user_id: int, action) -> asyncio.Future:
+        key = (chat_id, user_id)
+        task = asyncio.ensure_future(self.run(self.chains.get(key), action))
+        self.chains[key] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda _: self.done(key, task))
+        return task
+
+    async def run(self, previous, action):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            try:
+                await action()
+            except Exception as e:
+                print(f"Action error: {e}")
+
+    def done(self, key: tuple, task):
+        self.tasks.discard(task)
+        if self.chains.get(key) is task:
+            del self.chains[key]
+
+    async def drain(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+action_executor = ActionExecutor()
+
+
+def parse_duration(text: str) -> timedelta | None:
+    if not text:
+        return None
+    text = text.lower().strip()
+    try:
+        if text.endswith(("m", "м")):
+            return timedelta(minutes=int(text[:-1]))
+        elif text.endswith(("h", "ч")):
+            return timedelta(hours=int(text[:-1]))
+        elif text.endswith(("d", "д")):
+            return timedelta(days=int(text[:-1]))
+        elif text.endswith(("w", "н")):
+            return timedelta(weeks=int(text[:-1]))
+        elif text.isdigit():
+            return timedelta(minutes=int(text))
+    except ValueError:
+        pass
+    return None
+
+
+def format_duration(td: timedelta) -> str:
+    total_seconds = int(td.total_seconds())
+    if total_seconds < 3600:
+        return f"{total_seconds // 60} мин"
+    elif total_seconds < 86400:
+        return f"{total_seconds // 3600} ч"
+    else:
+        return f"{total_seconds // 86400} д"
+
+
+def compile_template(text: str) -> list[str]:
+    return [part for part in re.split(r"(\{user\}|\{chat\})", text) if part]
+
+
+def render_template(parts: list[str], values: dict) -> str:
+    return "".join([values.get(part, part) for part in parts])
+
+
+class Escalation:
+    def __init__(self, steps: list[tuple], source: str):
+        self.steps = steps
+        self.source = source
+        self.limit = steps[-1][0]
+        self.table = [None] * (self.limit + 1)
+        for count, action, duration in steps:
+            self.table[count] = (action, duration)
+
+    def step(self, warns: int) -> tuple | None:
+        return self.table[min(warns, self.limit)]
+
+    def describe(self) -> str:
+        names = {"mute": "🔇 мут", "ban": "🚫 бан", "kick": "👢 кик"}
+        lines = []
+        for count, action, duration in self.steps:
+            line = f"{count} → {names[action]}"
+            if duration:
+                line += f" на {format_duration(duration)}"
+            elif action == "ban":
+                line += " навсегда"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def compile_escalation(text: str) -> Escalation | None:
+    tokens = text.replace(",", " ").lower().split()
+    steps = {}
+    for token in tokens:
+        parts = token.split(":")
+        if len(parts) not in (2, 3) or not parts[0].isdigit() or parts[1] not in ESCALATION_ACTIONS:
+            return None
+        count = int(parts[0])
+        if not 1 <= count <= ESCALATION_MAX_WARNS:
+            return None
+        duration = None
+        if len(parts) == 3:
+            duration = parse_duration(parts[2])
+            if duration is None or parts[1] == "kick":
+                return None
+        elif parts[1] == "mute":
+            return None
+        steps[count] = (count, parts[1], duration)
+    if not steps:
+        return None
+    return Escalation([steps[count] for count in sorted(steps)], " ".join(tokens))
+
+default_escalation = compile_escalation(ESCALATION_DEFAULT)
+
+
+def format_user(user) -> str:
+    if user.username:
+        return f"{user.first_name} (@{user.username})"
+    return f"{user.first_name} [ID: {user.id}]"
+
+
+def get_warns(chat_id: int, user_id: int) -> int:
+    return db.warns.get(chat_id, user_id)
+
+
+def add_warn(chat_id: int, user_id: int) -> int:
+    return db.warns.add(chat_id, user_id)
+
+
+def remove_warn(chat_id: int, user_id: int) -> int:
+    return db.warns.remove(chat_id, user_id)
+
+
+def clear_warns(chat_id: int, user_id: int):
+    db.warns.clear(chat_id, user_id)
+
+
+async def is_admin(chat_id: int, user_id: int) -> bool:
+    if user_id in db.global_admins:
+        return True
+    try:
+        return user_id in await admin_cache.get(chat_id)
+    except:
+        return False
+
+
+async def can_restrict(chat_id: int, user_id: int) -> bool:
+    try:
+        return user_id not in await admin_cache.get(chat_id)
+    except:
+        return True
+
+
+async def get_target_user(message: Message, args: list):
+    if message.reply_to_message:
+        return message.reply_to_message.from_user, 1
+    if len(args) < 2:
+        return None, 0
+    identifier = args[1].strip()
+    if identifier.startswith("@"):
+        identifier = identifier[1:]
+        user = username_index.get(message.chat.id, identifier)
+        if user:
+            return user, 2
+    try:
+        user_id = int(identifier)
+        try:
+            member = await bot.get_chat_member(message.chat.id, user_id)
+            return member.user, 2
+        except:
+            return None, 0
+    except ValueError:
+        pass
+    return None, 0
+
+
+MUTE_PERMISSIONS = ChatPermissions(
+    can_send_messages=False,
+    can_send_media_messages=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False
+)
+UNMUTE_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_send_polls=True,
+    can_invite_users=True
+)
+
+
+async def ban_user(chat_id: int, user_id: int, duration: timedelta | None = None, reason: str = ""):
+    until_date = datetime.now() + duration if duration else None
+    await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+    response_cache.invalidate_user(chat_id, user_id)
+    if duration:
+        timed_actions.add(chat_id, user_id, "ban", time.time() + duration.total_seconds(), reason)
+    else:
+        timed_actions.cancel(chat_id, user_id, "ban")
+
+
+async def unban_user(chat_id: int, user_id: int):
+    await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+    response_cache.invalidate_user(chat_id, user_id)
+    timed_actions.cancel(chat_id, user_id, "ban")
+
+
+async def mute_user(chat_id: int, user_id: int, duration: timedelta, reason: str = ""):
+    await bot.restrict_chat_member(chat_id, user_id, permissions=MUTE_PERMISSIONS, until_date=datetime.now() + duration)
+    response_cache.invalidate_user(chat_id, user_id)
+    timed_actions.add(chat_id, user_id, "mute", time.time() + duration.total_seconds(), reason)
+
+
+async def unmute_user(chat_id: int, user_id: int):
+    await bot.restrict_chat_member(chat_id, user_id, permissions=UNMUTE_PERMISSIONS)
+    response_cache.invalidate_user(chat_id, user_id)
+    timed_actions.cancel(chat_id, user_id, "mute")
+
+
+async def kick_user(chat_id: int, user_id: int):
+    await bot.ban_chat_member(chat_id, user_id)
+    await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+    response_cache.invalidate_user(chat_id, user_id)
+
+
+class FloodMiddleware(BaseMiddleware):
+    def __init__(self, limit: int = FLOOD_LIMIT, window: float = FLOOD_WINDOW, max_tracked: int = FLOOD_MAX_TRACKED):
+        self.limit = limit
+        self.window = window
+        self.max_tracked = max_tracked
+        self.entries = OrderedDict()
+
+    def hit(self, chat_id: int, user_id: int) -> bool:
+        now = time.monotonic()
+        key = (chat_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.evict(now)
+            entry = self.entries[key] = [0, [float("-inf")] * self.limit]
+        else:
+            self.entries.move_to_end(key)
+        pos, ring = entry
+        flooded = now - ring[pos] < self.window
+        ring[pos] = now
+        entry[0] = (pos + 1) % self.limit
+        return flooded
+
+    def evict(self, now: float):
+        entries = self.entries
+        while entries:
+            pos, ring = next(iter(entries.values()))
+            if len(entries) < self.max_tracked and now - ring[pos - 1] < self.window:
+                break
+            entries.popitem(last=False)
+
+    async def __call__(self, handler, event: Message, data: dict):
+        user = event.from_user
+        if user is None or event.chat.type == "private" or not self.hit(event.chat.id, user.id):
+            return await handler(event, data)
+        self.entries.pop((event.chat.id, user.id), None)
+        if await is_admin(event.chat.id, user.id):
+            return await handler(event, data)
+        action_executor.submit(event.chat.id, user.id, lambda: self.mute(event, user))
+
+    async def mute(self, event: Message, user):
+        try:
+            await mute_user(event.chat.id, user.id, FLOOD_MUTE, "Флуд")
+            modlog.record(event.chat.id, user.id, None, "mute", "Флуд", FLOOD_MUTE)
+            await event.answer(
+                f"🔇 {format_user(user)} замучен за флуд на {format_duration(FLOOD_MUTE)}",
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            print(f"Flood mute error: {e}")
+
+flood_middleware = FloodMiddleware()
+
+
+class CommandSpec:
+    def __init__(
+        self,
+        group: bool = True,
+        admin: bool = False,
+        target: str | None = None,
+        reason: str | None = None,
+        duration: bool = False,
+        default_duration: timedelta | None = None,
+        protect: str | None = None,
+        usage: str = "❌ Ответьте на сообщение или укажите @user/ID"
+    ):
+        self.group = group
+        self.admin = admin
+        self.target = target
+        self.reason = reason
+        self.duration = duration
+        self.default_duration = default_duration
+        self.protect = protect
+        self.usage = usage
+
+
+class ParsedCommand:
+    def __init__(self, message: Message, admins: set | None = None):
+        self.args = message.text.split()
+        parts = message.text.split(maxsplit=1)
+        self.tail = parts[1] if len(parts) > 1 else ""
+        self.admins = admins
+        self.rest = self.args[1:]
+        self.target = None
+        self.user_id = None
+        self.reason = "Не указана"
+        self.duration = None
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in db.global_admins or (self.admins is not None and user_id in self.admins)
+
+    def can_restrict(self, user_id: int) -> bool:
+        return self.admins is None or user_id not in self.admins
+
+
+class CommandMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Message, data: dict):
+        spec = get_flag(data, "command")
+        if spec is None:
+            return await handler(event, data)
+        if spec.group and event.chat.type == "private":
+            return await event.reply("❌ Команда работает только в чатах")
+        admins = None
+        if spec.protect or (spec.admin and event.from_user.id not in db.global_admins):
+            try:
+                admins = await admin_cache.get(event.chat.id)
+            except Exception:
+                admins = None
+        parsed = ParsedCommand(event, admins)
+        if spec.admin and not parsed.is_admin(event.from_user.id):
+            return await event.reply("⛔ Нужны права администратора")
+        if spec.target == "id":
+            if len(parsed.args) < 2:
+                return await event.reply(spec.usage, parse_mode=ParseMode.HTML)
+            identifier = parsed.args[1].replace("@", "")
+            user = username_index.get(event.chat.id, identifier)
+            if user:
+                parsed.user_id = user.id
+            else:
+                try:
+                    parsed.user_id = int(identifier)
+                except ValueError:
+                    return await event.reply("❌ Пользователь не найден, укажите ID числом")
+            parsed.rest = parsed.args[2:]
+        elif spec.target:
+            parsed.target, offset = await get_target_user(event, parsed.args)
+            if parsed.target is None:
+                if spec.target == "required":
+                    return await event.reply(spec.usage, parse_mode=ParseMode.HTML)
+                if spec.target == "self":
+                    parsed.target = event.from_user
+            else:
+                parsed.rest = parsed.args[offset:]
+            if spec.protect and parsed.target and not parsed.can_restrict(parsed.target.id):
+                return await event.reply(spec.protect)
+        rest = parsed.rest
+        if spec.reason == "word" and rest:
+            parsed.reason = rest[0]
+        elif spec.reason == "rest" and rest:
+            parsed.reason = " ".join(rest)
+        if spec.duration:
+            parsed.duration = (parse_duration(rest[1]) if len(rest) >= 2 else None) or spec.default_duration
+        data["parsed"] = parsed
+        return await handler(event, data)
+
+
+@router.message(Command("start"))
+async def cmd_start(message: Message):
+    if message.chat.type == "private":
+        await message.answer(
+            "👨‍💼 <b>Бот модерации чатов</b>\n\n"
+            "Добавьте меня в чат и дайте права администратора.\n\n"
+            "<b>Команды:</b>\n"
+            "/ban @user причина время\n"
+            "/mute @user причина время\n"
+            "/warn @user причина\n"
+            "/kick @user\n\n"
+            "<b>Время:</b> 10m, 2h, 1d, 1w\n\n"
+            "Можно отвечать на сообщение вместо @user",
+            parse_mode=ParseMode.HTML
+        )
+
+
+@router.message(Command("help"))
+async def cmd_help(message: Message):
+    await response_cache.reply(message, ("help",), help_text)
+
+
+async def help_text() -> str:
+    return (
+        "📋 <b>Команды модерации</b>\n\n"
+        "<b>Баны:</b>\n"
+        "/ban причина время - ответом на сообщение\n"
+        "/ban @user причина время\n"
+        "/ban ID причина время\n"
+        "/unban @user или ID\n\n"
+        "<b>Муты:</b>\n"
+        "/mute причина время - ответом\n"
+        "/mute @user причина время\n"
+        "/unmute @user\n\n"
+        "<b>Варны:</b>\n"
+        "/warn причина - ответом\n"
+        "/warn @user причина\n"
+        "/unwarn @user\n"
+        "/clearwarns @user\n"
+        "/warns @user\n"
+        "/escalation - лестница наказаний\n"
+        "/setescalation 2:mute:1h 5:ban\n\n"
+        "<b>Другое:</b>\n"
+        "/kick - ответом или @user\n"
+        "/info - ответом или @user\n\n"
+        "<b>Массовые:</b>\n"
+        "/massban @user1 ID2 ...\n"
+        "/massban new 10m - зашедшие за 10 минут\n"
+        "/masskick, /massmute - так же\n"
+        "/active - активные баны и муты\n"
+        "/modlog - журнал модерации (ответом или @user)\n\n"
+        "<b>Бан-листы:</b>\n"
+        "/fednew имя - создать список\n"
+        "/fedsub имя, /fedunsub имя - подписать чат\n"
+        "/fedban @user имя - добавить и забанить\n"
+        "/fedunban @user имя\n"
+        "/fedlists - подписки чата\n\n"
+        "<b>Время:</b>\n"
+        "30m = 30 минут\n"
+        "2h = 2 часа\n"
+        "1d = 1 день\n"
+        "1w = 1 неделя"
+    )
+
+
+@router.message(Command("ban"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    reason="word",
+    duration=True,
+    protect="❌ Нельзя забанить администратора",
+    usage=(
+        "❌ <b>Пользователь не найден</b>\n\n"
+        "Использование:\n"
+        "• Ответьте на сообщение: /ban причина время\n"
+        "• Или: /ban @username причина время\n"
+        "• Или: /ban ID причина время"
+    )
+)})
+async def cmd_ban(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    try:
+        await ban_user(message.chat.id, target_user.id, parsed.duration, parsed.reason)
+        modlog.record(message.chat.id, target_user.id, message.from_user.id, "ban", parsed.reason, parsed.duration)
+        duration_text = format_duration(parsed.duration) if parsed.duration else "навсегда"
+        await message.reply(
+            f"🚫 <b>Пользователь забанен</b>\n\n"
+            f"👤 {format_user(target_user)}\n"
+            f"📝 Причина: {parsed.reason}\n"
+            f"⏱ Срок: {duration_text}",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("unban"), flags={"command": CommandSpec(
+    admin=True,
+    target="id",
+    usage="❌ Использование: /unban @user или /unban ID"
+)})
+async def cmd_unban(message: Message, parsed: ParsedCommand):
+    user_id = parsed.user_id
+    try:
+        await unban_user(message.chat.id, user_id)
+        modlog.record(message.chat.id, user_id, message.from_user.id, "unban")
+        await message.reply(f"✅ Пользователь {user_id} разбанен")
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("mute"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    reason="word",
+    duration=True,
+    default_duration=timedelta(hours=1),
+    protect="❌ Нельзя замутить администратора",
+    usage=(
+        "❌ <b>Пользователь не найден</b>\n\n"
+        "Использование:\n"
+        "• Ответьте на сообщение: /mute причина время\n"
+        "• Или: /mute @username причина время\n"
+        "• Или: /mute ID причина время"
+    )
+)})
+async def cmd_mute(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    try:
+        await mute_user(message.chat.id, target_user.id, parsed.duration, parsed.reason)
+        modlog.record(message.chat.id, target_user.id, message.from_user.id, "mute", parsed.reason, parsed.duration)
+        await message.reply(
+            f"🔇 <b>Пользователь замучен</b>\n\n"
+            f"👤 {format_user(target_user)}\n"
+            f"📝 Причина: {parsed.reason}\n"
+            f"⏱ Срок: {format_duration(parsed.duration)}",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("unmute"), flags={"command": CommandSpec(admin=True, target="required")})
+async def cmd_unmute(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    try:
+        await unmute_user(message.chat.id, target_user.id)
+        modlog.record(message.chat.id, target_user.id, message.from_user.id, "unmute")
+        await message.reply(f"🔊 {format_user(target_user)} размучен", parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("warn"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    reason="rest",
+    protect="❌ Нельзя дать варн администратору",
+    usage=(
+        "❌ <b>Пользователь не найден</b>\n\n"
+        "Использование:\n"
+        "• Ответьте на сообщение: /warn причина\n"
+        "• Или: /warn @username причина"
+    )
+)})
+async def cmd_warn(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    chat_id = message.chat.id
+    warns = add_warn(chat_id, target_user.id)
+    modlog.record(chat_id, target_user.id, message.from_user.id, "warn", parsed.reason)
+    escalation = db.escalation_for(chat_id)
+    step = escalation.step(warns)
+    if step is None:
+        return await message.reply(
+            f"⚠️ <b>Предупреждение</b>\n\n"
+            f"👤 {format_user(target_user)}\n"
+            f"📝 Причина: {parsed.reason}\n"
+            f"⚠️ Варнов: {warns}/{escalation.limit}",
+            parse_mode=ParseMode.HTML
+        )
+    count = f"{min(warns, escalation.limit)}/{escalation.limit}"
+    reset = warns >= escalation.limit
+    action_executor.submit(chat_id, target_user.id, lambda: escalate(message, target_user, step, count, parsed.reason, reset))
+
+
+async def escalate(message: Message, user, step: tuple, count: str, warn_reason: str, reset: bool = False):
+    reason = f"{count} предупреждений"
+    action, duration = step
+    chat_id = message.chat.id
+    try:
+        if action == "mute":
+            await mute_user(chat_id, user.id, duration, reason)
+            title = "🔇 <b>Пользователь замучен</b>"
+        elif action == "ban":
+            await ban_user(chat_id, user.id, duration, reason)
+            title = "🚫 <b>Пользователь забанен</b>"
+        else:
+            await kick_user(chat_id, user.id)
+            title = "👢 <b>Пользователь кикнут</b>"
+        modlog.record(chat_id, user.id, message.from_user.id, action, reason, duration)
+    except Exception as e:
+        return await message.reply(f"❌ Ошибка: {e}")
+    if reset:
+        clear_warns(chat_id, user.id)
+    text = f"{title}\n\n👤 {format_user(user)}\n📝 Причина: {warn_reason}\n⚠️ Варнов: {count}"
+    if action != "kick":
+        text += f"\n⏱ Срок: {format_duration(duration) if duration else 'навсегда'}"
+    await message.reply(text, parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("unwarn"), flags={"command": CommandSpec(admin=True, target="required")})
+async def cmd_unwarn(message: Message, parsed: ParsedCommand):
+    warns = remove_warn(message.chat.id, parsed.target.id)
+    await message.reply(
+        f"✅ Варн снят\n\n👤 {format_user(parsed.target)}\n⚠️ Осталось: {warns}/{db.escalation_for(message.chat.id).limit}",
+        parse_mode=ParseMode.HTML
+    )
+
+
+@router.message(Command("clearwarns"), flags={"command": CommandSpec(admin=True, target="required")})
+async def cmd_clearwarns(message: Message, parsed: ParsedCommand):
+    clear_warns(message.chat.id, parsed.target.id)
+    await message.reply(f"✅ Все варны сняты с {format_user(parsed.target)}", parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("warns"), flags={"command": CommandSpec(target="self")})
+async def cmd_warns(message: Message, parsed: ParsedCommand):
+    async def build() -> str:
+        warns = get_warns(message.chat.id, parsed.target.id)
+        return f"⚠️ У {format_user(parsed.target)} варнов: {warns}/{db.escalation_for(message.chat.id).limit}"
+
+    await response_cache.reply(message, ("warns", parsed.target.id), build)
+
+
+@router.message(Command("kick"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    protect="❌ Нельзя кикнуть администратора"
+)})
+async def cmd_kick(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    try:
+        await kick_user(message.chat.id, target_user.id)
+        modlog.record(message.chat.id, target_user.id, message.from_user.id, "kick")
+        await message.reply(f"👢 {format_user(target_user)} кикнут", parse_mode=ParseMode.HTML)
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+class RecentJoins:
+    def __init__(self, size: int = RECENT_JOINS_SIZE, ttl: float = RECENT_JOINS_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.chats = {}
+
+    def add(self, chat_id: int, users: list):
+        now = time.time()
+        joins = self.chats.get(chat_id)
+        if joins is None:
+            joins = self.chats[chat_id] = deque(maxlen=self.size)
+        while joins and joins[0][0] < now - self.ttl:
+            joins.popleft()
+        for user in users:
+            joins.append((now, user.id))
+
+    def since(self, chat_id: int, seconds: float) -> list[int]:
+        cutoff = time.time() - seconds
+        return [user_id for joined, user_id in self.chats.get(chat_id, ()) if joined >= cutoff]
+
+recent_joins = RecentJoins()
+
+
+def resolve_bulk_targets(message: Message, args: list) -> tuple[list[int], list[str]]:
+    if len(args) >= 2 and args[1].lower() in ("new", "новые"):
+        window = parse_duration(args[2]) if len(args) >= 3 else None
+        if not window:
+            return [], []
+        return list(dict.fromkeys(recent_joins.since(message.chat.id, window.total_seconds()))), []
+    targets = {}
+    failed = []
+    for identifier in args[1:]:
+        name = identifier.lstrip("@")
+        user = username_index.get(message.chat.id, name) if identifier.startswith("@") else None
+        if user:
+            targets[user.id] = None
+            continue
+        try:
+            targets[int(name)] = None
+        except ValueError:
+            failed.append(f"{identifier}: не найден")
+    return list(targets), failed
+
+
+async def run_bulk(message: Message, title: str, kind: str, action, targets: list[int], failed: list[str]):
+    chat_id = message.chat.id
+    me = await get_bot_user()
+    targets = [user_id for user_id in targets[:BULK_MAX_TARGETS] if user_id != me.id]
+    errors = list(failed)
+    status = await message.reply(f"⏳ {title}: 0/{len(targets)}")
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    progress = {"done": 0, "ok": 0, "edited": time.monotonic()}
+
+    async def run(user_id: int):
+        async with semaphore:
+            try:
+                if await can_restrict(chat_id, user_id):
+                    await action(chat_id, user_id)
+                    modlog.record(chat_id, user_id, message.from_user.id, kind, title)
+                    progress["ok"] += 1
+                else:
+                    errors.append(f"{user_id}: администратор")
+            except Exception as e:
+                errors.append(f"{user_id}: {e}")
+        progress["done"] += 1
+        if progress["done"] < len(targets) and time.monotonic() - progress["edited"] >= BULK_PROGRESS_INTERVAL:
+            progress["edited"] = time.monotonic()
+            try:
+                await status.edit_text(f"⏳ {title}: {progress['done']}/{len(targets)}")
+            except Exception:
+                pass
+
+    await asyncio.gather(*(run(user_id) for user_id in targets))
+    text = (
+        f"✅ <b>{title}: готово</b>\n\n"
+        f"Успешно: {progress['ok']}\n"
+        f"Ошибок: {len(errors)}"
+    )
+    if errors:
+        text += "\n\n" + "\n".join(html.escape(error) for error in errors[:10])
+        if len(errors) > 10:
+            text += f"\n… и ещё {len(errors) - 10}"
+    try:
+        await status.edit_text(text, parse_mode=ParseMode.HTML)
+    except Exception:
+        await message.reply(text, parse_mode=ParseMode.HTML)
+
+
+async def cmd_bulk(message: Message, parsed: ParsedCommand, title: str, kind: str, action):
+    targets, failed = resolve_bulk_targets(message, parsed.args)
+    if not targets:
+        command = parsed.args[0]
+        return await message.reply(
+            "❌ <b>Нет пользователей</b>\n\n"
+            "Использование:\n"
+            f"• {command} @user1 ID2 @user3\n"
+            f"• {command} new 10m - зашедшие за последние 10 минут",
+            parse_mode=ParseMode.HTML
+        )
+    await run_bulk(message, title, kind, action, targets, failed)
+
+
+@router.message(Command("massban"), flags={"command": CommandSpec(admin=True)})
+async def cmd_massban(message: Message, parsed: ParsedCommand):
+    await cmd_bulk(message, parsed, "Массовый бан", "ban", ban_user)
+
+
+@router.message(Command("masskick"), flags={"command": CommandSpec(admin=True)})
+async def cmd_masskick(message: Message, parsed: ParsedCommand):
+    await cmd_bulk(message, parsed, "Массовый кик", "kick", kick_user)
+
+
+@router.message(Command("massmute"), flags={"command": CommandSpec(admin=True)})
+async def cmd_massmute(message: Message, parsed: ParsedCommand):
+    await cmd_bulk(message, parsed, "Массовый мут", "mute", lambda chat_id, user_id: mute_user(chat_id, user_id, timedelta(hours=1)))
+
+
+@router.message(Command("active"), flags={"command": CommandSpec(admin=True)})
+async def cmd_active(message: Message):
+    actions = timed_actions.active(message.chat.id)
+    if not actions:
+        return await message.reply("✅ Активных банов и мутов нет")
+    now = time.time()
+    lines = []
+    for expires, user_id, kind, reason in actions[:ACTIVE_LIST_LIMIT]:
+        icon = "🚫" if kind == "ban" else "🔇"
+        left = format_duration(timedelta(seconds=max(60, expires - now)))
+        line = f"{icon} <a href=\"tg://user?id={user_id}\">{user_id}</a> — {left}"
+        if reason:
+            line += f" ({html.escape(reason)})"
+        lines.append(line)
+    if len(actions) > ACTIVE_LIST_LIMIT:
+        lines.append(f"… и ещё {len(actions) - ACTIVE_LIST_LIMIT}")
+    await message.reply(
+        f"⏱ <b>Активные ограничения: {len(actions)}</b>\n\n" + "\n".join(lines),
+        parse_mode=ParseMode.HTML
+    )
+
+
+MODLOG_ACTIONS = {
+    "ban": "🚫 бан",
+    "unban": "✅ разбан",
+    "mute": "🔇 мут",
+    "unmute": "🔊 размут",
+    "warn": "⚠️ варн",
+    "kick": "👢 кик"
+}
+
+
+@router.message(Command("modlog"), flags={"command": CommandSpec(admin=True, target="optional")})
+async def cmd_modlog(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    records = await modlog.query(message.chat.id, target_user.id if target_user else None)
+    title = f"📒 <b>Журнал: {format_user(target_user)}</b>" if target_user else "📒 <b>Журнал модерации</b>"
+    if not records:
+        return await message.reply(f"{title}\n\nЗаписей нет", parse_mode=ParseMode.HTML)
+    lines = []
+    for record in records:
+        line = f"{datetime.fromtimestamp(record['ts']):%d.%m %H:%M} {MODLOG_ACTIONS.get(record['action'], record['action'])}"
+        if not target_user:
+            line += f" <code>{record['user']}</code>"
+        if record["duration"]:
+            line += f" на {format_duration(timedelta(seconds=record['duration']))}"
+        if record["reason"]:
+            line += f" — {html.escape(record['reason'])}"
+        line += f" (<code>{record['admin']}</code>)" if record["admin"] else " (авто)"
+        lines.append(line)
+    await message.reply(f"{title}\n\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("fednew"), flags={"command": CommandSpec(admin=True)})
+async def cmd_fednew(message: Message, parsed: ParsedCommand):
+    if not parsed.rest:
+        return await message.reply("❌ Использование: /fednew имя")
+    name = parsed.rest[0].lower()
+    if not federated_bans.create(name, message.from_user.id):
+        return await message.reply("❌ Такой бан-лист уже есть")
+    await message.reply(f"✅ Бан-лист <b>{html.escape(name)}</b> создан", parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("fedsub"), flags={"command": CommandSpec(admin=True)})
+async def cmd_fedsub(message: Message, parsed: ParsedCommand):
+    if not parsed.rest:
+        return await message.reply("❌ Использование: /fedsub имя")
+    name = parsed.rest[0].lower()
+    if name not in federated_bans.lists:
+        return await message.reply("❌ Бан-лист не найден")
+    federated_bans.subscribe(message.chat.id, name)
+    await message.reply(f"✅ Чат подписан на <b>{html.escape(name)}</b>", parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("fedunsub"), flags={"command": CommandSpec(admin=True)})
+async def cmd_fedunsub(message: Message, parsed: ParsedCommand):
+    if not parsed.rest:
+        return await message.reply("❌ Использование: /fedunsub имя")
+    if not federated_bans.unsubscribe(message.chat.id, parsed.rest[0].lower()):
+        return await message.reply("❌ Чат не подписан на этот бан-лист")
+    await message.reply("✅ Подписка отменена")
+
+
+@router.message(Command("fedlists"), flags={"command": CommandSpec()})
+async def cmd_fedlists(message: Message):
+    names = sorted(federated_bans.subscriptions.get(message.chat.id, ()))
+    if not names:
+        return await message.reply("📋 Чат не подписан на бан-листы")
+    lines = [f"• <b>{html.escape(name)}</b> — {len(federated_bans.lists[name])}" for name in names]
+    await message.reply("📋 <b>Бан-листы чата</b>\n\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("fedban"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    protect="❌ Нельзя забанить администратора",
+    usage="❌ Использование: /fedban @user имя или ответом: /fedban имя"
+)})
+async def cmd_fedban(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+    if not parsed.rest:
+        return await message.reply("❌ Использование: /fedban @user имя или ответом: /fedban имя")
+    name = parsed.rest[0].lower()
+    if not federated_bans.can_edit(name, message.from_user.id):
+        return await message.reply("⛔ Бан-лист не найден или вы не его владелец")
+    federated_bans.add(name, target_user.id)
+    try:
+        await ban_user(message.chat.id, target_user.id)
+        modlog.record(message.chat.id, target_user.id, message.from_user.id, "ban", f"Бан-лист {name}")
+        await message.reply(
+            f"🚫 {format_user(target_user)} добавлен в <b>{html.escape(name)}</b> и забанен",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("fedunban"), flags={"command": CommandSpec(
+    admin=True,
+    target="required",
+    usage="❌ Использование: /fedunban @user имя или ответом: /fedunban имя"
+)})
+async def cmd_fedunban(message: Message, parsed: ParsedCommand):
+    if not parsed.rest:
+        return await message.reply("❌ Использование: /fedunban @user имя или ответом: /fedunban имя")
+    name = parsed.rest[0].lower()
+    if not federated_bans.can_edit(name, message.from_user.id):
+        return await message.reply("⛔ Бан-лист не найден или вы не его владелец")
+    federated_bans.remove(name, parsed.target.id)
+    await message.reply(
+        f"✅ {format_user(parsed.target)} удалён из <b>{html.escape(name)}</b>",
+        parse_mode=ParseMode.HTML
+    )
+
+
+@router.message(Command("info"), flags={"command": CommandSpec(target="self")})
+async def cmd_info(message: Message, parsed: ParsedCommand):
+    target_user = parsed.target
+
+    async def build() -> str:
+        member = await bot.get_chat_member(message.chat.id, target_user.id)
+        status_map = {
+            "creator": "👑 Создатель",
+            "administrator": "👨‍💼 Админ",
+            "member": "👤 Участник",
+            "restricted": "🔇 Ограничен",
+            "left": "🚪 Покинул",
+            "kicked": "🚫 Забанен"
+        }
+        status = status_map.get(member.status, member.status)
+        warns = get_warns(message.chat.id, target_user.id)
+        username_text = f"@{target_user.username}" if target_user.username else "нет"
+        return (
+            f"👤 <b>Информация</b>\n\n"
+            f"🆔 ID: <code>{target_user.id}</code>\n"
+            f"📛 Имя: {target_user.first_name}\n"
+            f"👤 Username: {username_text}\n"
+            f"📊 Статус: {status}\n"
+            f"⚠️ Варнов: {warns}/{db.escalation_for(message.chat.id).limit}"
+        )
+
+    try:
+        await response_cache.reply(message, ("info", target_user.id), build)
+    except Exception as e:
+        await message.reply(f"❌ Ошибка: {e}")
+
+
+@router.message(Command("setrules"), flags={"command": CommandSpec(admin=True)})
+async def cmd_setrules(message: Message, parsed: ParsedCommand):
+    if not parsed.tail:
+        return await message.reply("❌ Использование: /setrules текст правил")
+    db.set_rules(message.chat.id, parsed.tail)
+    await message.reply("✅ Правила установлены")
+
+
+@router.message(Command("rules"), flags={"command": CommandSpec()})
+async def cmd_rules(message: Message):
+    async def build() -> str:
+        return f"📜 <b>Правила чата</b>\n\n{db.rules.get(message.chat.id, 'Правила не установлены')}"
+
+    await response_cache.reply(message, ("rules",), build)
+
+
+@router.message(Command("setescalation"), flags={"command": CommandSpec(admin=True)})
+async def cmd_setescalation(message: Message, parsed: ParsedCommand):
+    if not parsed.rest:
+        return await message.reply(
+            "❌ Использование: /setescalation 2:mute:1h 3:mute:1d 5:ban\n\n"
+            "Действия: mute:время, ban, ban:время, kick\n"
+            "/setescalation default - по умолчанию"
+        )
+    if parsed.rest[0].lower() == "default":
+        db.set_escalation(message.chat.id, None)
+        return await message.reply("✅ Лестница наказаний сброшена")
+    escalation = compile_escalation(parsed.tail)
+    if escalation is None:
+        return await message.reply(f"❌ Неверный формат. Пример: 2:mute:1h 3:mute:1d 5:ban (варнов до {ESCALATION_MAX_WARNS})")
+    db.set_escalation(message.chat.id, escalation)
+    await message.reply(f"✅ <b>Лестница наказаний</b>\n\n{escalation.describe()}", parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("escalation"), flags={"command": CommandSpec()})
+async def cmd_escalation(message: Message):
+    escalation = db.escalation_for(message.chat.id)
+    await message.reply(f"⚖️ <b>Лестница наказаний</b>\n\n{escalation.describe()}", parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("setwelcome"), flags={"command": CommandSpec(admin=True)})
+async def cmd_setwelcome(message: Message, parsed: ParsedCommand):
+    if not parsed.tail:
+        return await message.reply("❌ Использование: /setwelcome текст\n\n{user} - имя\n{chat} - название чата")
+    db.set_welcome(message.chat.id, parsed.tail)
+    await message.reply("✅ Приветствие установлено")
+
+
+@router.message(Command("delwelcome"), flags={"command": CommandSpec(admin=True)})
+async def cmd_delwelcome(message: Message):
+    db.set_welcome(message.chat.id, None)
+    await message.reply("✅ Приветствие удалено")
+
+
+class JoinAggregator:
+    def __init__(self, window: float = WELCOME_BATCH_WINDOW, cap: int = WELCOME_BATCH_CAP):
+        self.window = window
+        self.cap = cap
+        self.pending = {}
+
+    def add(self, chat, users: list):
+        entry = self.pending.get(chat.id)
+        if entry is None:
+            entry = self.pending[chat.id] = [chat.title, [], 0]
+            asyncio.ensure_future(self.flush_later(chat.id))
+        for user in users:
+            if len(entry[1]) < self.cap:
+                entry[1].append(html.escape(user.first_name))
+            else:
+                entry[2] += 1
+
+    async def flush_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        title, names, extra = self.pending.pop(chat_id)
+        template = db.welcome_templates.get(chat_id)
+        if not template:
+            return
+        users_text = ", ".join(names)
+        if extra:
+            users_text += f" и ещё {extra}"
+        text = render_template(template, {"{user}": users_text, "{chat}": html.escape(title or "чат")})
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+        except Exception as e:
+            print(f"Welcome error: {e}")
+
+join_aggregator = JoinAggregator()
+
+
+async def get_bot_user():
+    global bot_user
+    if bot_user is None:
+        bot_user = await bot.get_me()
+    return bot_user
+
+
+async def apply_federated_ban(chat_id: int, user) -> bool:
+    name = federated_bans.match(chat_id, user.id)
+    if name is None:
+        return False
+    try:
+        await ban_user(chat_id, user.id)
+        modlog.record(chat_id, user.id, None, "ban", f"Бан-лист {name}")
+        await bot.send_message(
+            chat_id,
+            f"🚫 {format_user(user)} забанен: в бан-листе <b>{html.escape(name)}</b>",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        print(f"Federated ban error: {e}")
+    return True
+
+
+@router.message(F.new_chat_members)
+async def on_new_member(message: Message):
+    me = await get_bot_user()
+    bot_joined = any(user.id == me.id for user in message.new_chat_members)
+    users = [user for user in message.new_chat_members if user.id != me.id]
+    recent_joins.add(message.chat.id, users)
+    if message.chat.id in federated_bans.subscriptions:
+        users = [user for user in users if not await apply_federated_ban(message.chat.id, user)]
+    if bot_joined:
+        await message.reply(
+            "👋 <b>Привет! Я бот модерации.</b>\n\n"
+            "Дайте мне права администратора.\n"
+            "Команды: /help",
+            parse_mode=ParseMode.HTML
+        )
+    if users and message.chat.id in db.welcome_templates:
+        join_aggregator.add(message.chat, users)
+
+
+@router.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    user_id = event.new_chat_member.user.id
+    status = event.new_chat_member.status
+    admin_cache.update(event.chat.id, user_id, status)
+    response_cache.invalidate_user(event.chat.id, user_id)
+    if status != "kicked":
+        timed_actions.cancel(event.chat.id, user_id, "ban")
+    if status != "restricted":
+        timed_actions.cancel(event.chat.id, user_id, "mute")
+
+
+@router.my_chat_member()
+async def on_my_chat_member(event: ChatMemberUpdated):
+    if event.new_chat_member.status in ("left", "kicked"):
+        admin_cache.invalidate(event.chat.id)
+    else:
+        admin_cache.update(event.chat.id, event.new_chat_member.user.id, event.new_chat_member.status)
+
+
+class WebhookServer:
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE, feed=None):
+        self.queue_size = queue_size
+        self.tasks = set()
+        self.feed = feed or (lambda update: dp.feed_update(bot, update))
+        metrics.gauge("bot_webhook_queue", lambda: [({}, len(self.tasks))])
+        self.app = web.Application()
+        self.app.router.add_post(WEBHOOK_PATH, self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET:
+            token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        if len(self.tasks) >= self.queue_size:
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        task = asyncio.ensure_future(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process(self, update: Update):
+        try:
+            await self.feed(update)
+        except Exception as e:
+            print(f"Update error: {e}")
+
+    async def serve(self, on_start=None):
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    WEBHOOK_URL + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=dp.resolve_used_update_types()
+                )
+            print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            if on_start:
+                on_start()
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+def collect_queue_metrics() -> list[tuple]:
+    stats = [({"stat": key}, value) for key, value in update_executor.stats().items()]
+    stats.append(({"stat": "pending_actions"}, len(action_executor.tasks)))
+    return stats
+
+
+def collect_cache_metrics() -> list[tuple]:
+    return [
+        ({"cache": "admin", "result": "hit"}, admin_cache.hits),
+        ({"cache": "admin", "result": "miss"}, admin_cache.misses),
+        ({"cache": "username", "result": "hit"}, username_index.hits),
+        ({"cache": "username", "result": "miss"}, username_index.misses),
+        ({"cache": "response", "result": "hit"}, response_cache.hits),
+        ({"cache": "response", "result": "miss"}, response_cache.misses),
+        ({"cache": "response", "result": "suppressed"}, response_cache.suppressed)
+    ]
+
+
+def collect_size_metrics() -> list[tuple]:
+    return [
+        ({"store": "admin_chats"}, len(admin_cache.chats)),
+        ({"store": "usernames"}, len(username_index.entries)),
+        ({"store": "flood_entries"}, len(flood_middleware.entries)),
+        ({"store": "warn_chats"}, len(db.warns.chats)),
+        ({"store": "timed_actions"}, timed_actions.count),
+        ({"store": "db_pending_writes"}, len(db.pending))
+    ]
+
+
+def collect_startup_metrics() -> list[tuple]:
+    phases = [("critical", startup.critical_seconds), ("warmup", startup.warmup_seconds), ("first_update", startup.first_update)]
+    return [({"phase": phase}, value) for phase, value in phases if value is not None]
+
+
+class Startup:
+    def __init__(self, rate: float = WARMUP_RATE, concurrency: int = WARMUP_CONCURRENCY, max_chats: int = WARMUP_MAX_CHATS):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_chats = max_chats
+        self.ready = False
+        self.critical_seconds = None
+        self.warmup_seconds = None
+        self.first_update = None
+        self.total = 0
+        self.warmed = 0
+        self.failed = 0
+        self.task = None
+
+    async def critical(self):
+        started = time.monotonic()
+        await asyncio.gather(self.prefetch_bot_user(), timed_actions.load(), federated_bans.load())
+        self.critical_seconds = time.monotonic() - started
+
+    async def prefetch_bot_user(self):
+        try:
+            await get_bot_user()
+        except Exception as e:
+            print(f"getMe error: {e}")
+
+    def start_warmup(self):
+        self.task = asyncio.ensure_future(self.warmup())
+
+    async def warmup(self):
+        started = time.monotonic()
+        chat_ids = await asyncio.to_thread(db.storage.load_chat_ids)
+        if shard is not None:
+            chat_ids = [chat_id for chat_id in chat_ids if shard_of(chat_id) == shard]
+        chat_ids = chat_ids[:min(self.max_chats, int(self.rate * admin_cache.ttl))]
+        self.total = len(chat_ids)
+        bucket = TokenBucket(self.rate, self.concurrency)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def warm(chat_id: int):
+            async with semaphore:
+                try:
+                    await db.load_chat(chat_id)
+                    if chat_id not in admin_cache.chats:
+                        delay = bucket.reserve()
+                        if delay:
+                            await asyncio.sleep(delay)
+                        await admin_cache.get(chat_id)
+                except Exception:
+                    self.failed += 1
+                self.warmed += 1
+
+        await asyncio.gather(*(warm(chat_id) for chat_id in chat_ids))
+        self.warmup_seconds = time.monotonic() - started
+        self.ready = True
+        print(f"Кэши прогреты: {self.total} чатов за {self.warmup_seconds:.1f}s, ошибок: {self.failed}")
+
+    def update_handled(self):
+        self.first_update = time.monotonic() - STARTED_AT
+        if self.first_update > STARTUP_TARGET:
+            print(f"Первый апдейт обработан через {self.first_update:.1f}s (цель {STARTUP_TARGET:.0f}s)")
+
+startup = Startup()
+
+
+def setup_dispatcher():
+    dp.update.outer_middleware(update_executor)
+    router.message.outer_middleware(ChatLoadMiddleware())
+    router.message.outer_middleware(UsernameIndexMiddleware())
+    router.message.outer_middleware(flood_middleware)
+    router.message.middleware(HandlerMetricsMiddleware())
+    router.message.middleware(CommandMiddleware())
+    router.chat_member.middleware(HandlerMetricsMiddleware())
+    router.my_chat_member.middleware(HandlerMetricsMiddleware())
+    dp.include_router(router)
+    metrics.gauge("bot_update_queue", collect_queue_metrics)
+    metrics.gauge("bot_cache_requests", collect_cache_metrics)
+    metrics.gauge("bot_store_size", collect_size_metrics)
+    metrics.gauge("bot_ready", lambda: [({}, int(startup.ready))])
+    metrics.gauge("bot_startup_seconds", collect_startup_metrics)
+
+
+class TunedSession(AiohttpSession):
+    def __init__(self, **kwargs):
+        if orjson is not None:
+            kwargs.setdefault("json_loads", orjson.loads)
+            kwargs.setdefault("json_dumps", lambda obj: orjson.dumps(obj).decode())
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        super().__init__(limit=HTTP_POOL_SIZE, **kwargs)
+        self._connector_init.update(
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL
+        )
+
+    async def make_request(self, bot, method, timeout: int | None = None):
+        if timeout is None:
+            timeout = HTTP_METHOD_TIMEOUTS.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout)
+
+
+class SingleFlight(BaseRequestMiddleware):
+    def __init__(self):
+        self.pending = {}
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if name not in SINGLE_FLIGHT_METHODS:
+            return await make_request(bot, method)
+        key = (name, getattr(method, "chat_id", None), getattr(method, "user_id", None))
+        task = self.pending.get(key)
+        if task is None:
+            metrics.inc("bot_single_flight_total", method=name, result="leader")
+            task = asyncio.ensure_future(make_request(bot, method))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        else:
+            metrics.inc("bot_single_flight_total", method=name, result="shared")
+        return await asyncio.shield(task)
+
+single_flight = SingleFlight()
+
+
+def create_bot() -> Bot:
+    api = TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else None
+    session = TunedSession(api=api) if api else TunedSession()
+    new_bot = Bot(token=BOT_TOKEN, session=session)
+    new_bot.session.middleware(single_flight)
+    new_bot.session.middleware(send_scheduler)
+    new_bot.session.middleware(api_metrics)
+    return new_bot
+
+
+def shard_of(chat_id: int) -> int:
+    return chat_id % SHARDS
+
+
+def update_chat_id(update: Update) -> int | None:
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = event.message.chat
+    return chat.id if chat else None
+
+
+class ShardRouter:
+    def __init__(self, count: int = SHARDS, check_interval: float = SHARD_CHECK_INTERVAL):
+        self.context = multiprocessing.get_context("spawn")
+        self.count = count
+        self.check_interval = check_interval
+        self.queues = [None] * count
+        self.results = [None] * count
+        self.processes = [None] * count
+        self.outboxes = [asyncio.Queue() for _ in range(count)]
+        self.senders = [None] * count
+        self.receivers = [None] * count
+        self.backoffs = [Backoff() for _ in range(count)]
+        self.pending = {}
+        self.loop = None
+        self.supervisor = None
+        metrics.gauge("bot_shard_alive", lambda: [
+            ({"shard": index}, int(process is not None and process.is_alive()))
+            for index, process in enumerate(self.processes)
+        ])
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        for index in range(self.count):
+            self.spawn(index)
+        self.supervisor = asyncio.ensure_future(self.supervise())
+
+    def spawn(self, index: int):
+        self.queues[index] = self.context.Queue(SHARD_QUEUE_SIZE)
+        self.results[index] = self.context.Queue()
+        self.processes[index] = self.context.Process(
+            target=run_shard,
+            args=(index, self.queues[index], self.results[index]),
+            daemon=True,
+            name=f"shard-{index}"
+        )
+        self.processes[index].start()
+        self.receivers[index] = threading.Thread(
+            target=self.receive, args=(index, self.results[index]), daemon=True, name=f"shard-{index}-results"
+        )
+        self.receivers[index].start()
+        self.senders[index] = asyncio.ensure_future(self.send(index))
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    await self.restart(index)
+
+    async def restart(self, index: int):
+        print(f"Шард {index} упал (код {self.processes[index].exitcode}), перезапуск")
+        metrics.inc("bot_shard_restarts_total", shard=index)
+        self.senders[index].cancel()
+        results, self.results[index] = self.results[index], None
+        await asyncio.to_thread(self.receivers[index].join)
+        try:
+            while True:
+                update_ids = results.get_nowait()
+                if update_ids:
+                    self.resolve(update_ids)
+        except queue.Empty:
+            pass
+        await asyncio.sleep(self.backoffs[index].next())
+        self.outboxes[index] = outbox = asyncio.Queue()
+        for update_id, entry in self.pending.items():
+            if entry[0] == index:
+                outbox.put_nowait(update_id)
+        self.spawn(index)
+
+    async def feed(self, update: Update):
+        entry = self.pending.get(update.update_id)
+        if entry is None:
+            chat_id = update_chat_id(update)
+            index = shard_of(chat_id) if chat_id is not None else 0
+            future = asyncio.get_running_loop().create_future()
+            entry = self.pending[update.update_id] = (index, update.model_dump_json(exclude_none=True, by_alias=True), future)
+            self.outboxes[index].put_nowait(update.update_id)
+        await asyncio.shield(entry[2])
+
+    async def send(self, index: int):
+        outbox = self.outboxes[index]
+        shard_queue = self.queues[index]
+        while True:
+            update_id = await outbox.get()
+            entry = self.pending.get(update_id)
+            if entry is None:
+                continue
+            try:
+                try:
+                    shard_queue.put_nowait(entry[1])
+                except queue.Full:
+                    while not await asyncio.to_thread(self.put, shard_queue, entry[1]):
+                        pass
+            except Exception as e:
+                self.fail(update_id, e)
+
+    def put(self, shard_queue, data: str | None) -> bool:
+        try:
+            shard_queue.put(data, timeout=self.check_interval)
+        except queue.Full:
+            return False
+        return True
+
+    def receive(self, index: int, results):
+        while self.results[index] is results:
+            try:
+                update_ids = results.get(timeout=self.check_interval)
+            except queue.Empty:
+                continue
+            if update_ids is None:
+                return
+            self.loop.call_soon_threadsafe(self.resolve, update_ids)
+
+    def resolve(self, update_ids: list[int]):
+        for update_id in update_ids:
+            entry = self.pending.pop(update_id, None)
+            if entry is not None:
+                self.backoffs[entry[0]].reset()
+                if not entry[2].done():
+                    entry[2].set_result(None)
+
+    def fail(self, update_id: int, error: Exception):
+        entry = self.pending.pop(update_id, None)
+        if entry is not None and not entry[2].done():
+            entry[2].set_exception(error)
+
+    async def stop(self):
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+        futures = [entry[2] for entry in self.pending.values()]
+        if futures:
+            await asyncio.wait(futures, timeout=10)
+        for task in self.senders:
+            if task is not None:
+                task.cancel()
+        await asyncio.to_thread(self.join)
+
+    def join(self):
+        for shard_queue in self.queues:
+            self.put(shard_queue, None)
+        for process in self.processes:
+            process.join(timeout=10)
+        for results in self.results:
+            if results is not None:
+                results.put(None)
+        for thread in self.receivers:
+            thread.join(timeout=10)
+
+
+def run_shard(index: int, shard_queue, results):
+    asyncio.run(shard_main(index, shard_queue, results))
+
+
+async def shard_main(index: int, shard_queue, results):
+    global bot, shard
+    shard = index
+    modlog.path = os.path.join(MODLOG_DIR, f"shard-{index}")
+    send_scheduler.global_bucket = TokenBucket(SEND_GLOBAL_RATE / SHARDS, SEND_GLOBAL_RATE / SHARDS)
+    bot = create_bot()
+    setup_dispatcher()
+    await startup.critical()
+    startup.start_warmup()
+    if METRICS_PORT:
+        await metrics.serve(METRICS_PORT + 1 + index)
+    tasks = set()
+    acks = []
+    ack_task = None
+
+    def processed(update_id: int):
+        nonlocal ack_task
+        acks.append(update_id)
+        if ack_task is None or ack_task.done():
+            ack_task = asyncio.ensure_future(send_acks())
+
+    async def send_acks():
+        backoff = Backoff()
+        while acks:
+            batch = acks[:]
+            del acks[:]
+            while not await db.flush():
+                await asyncio.sleep(backoff.next())
+            results.put(batch)
+
+    try:
+        print(f"Шард {index} запущен")
+        while True:
+            data = await asyncio.to_thread(shard_queue.get)
+            if data is None:
+                break
+            update = Update.model_validate_json(data, context={"bot": bot})
+            task = asyncio.ensure_future(dp.feed_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _, update_id=update.update_id: processed(update_id))
+        if tasks:
+            await asyncio.wait(tasks)
+        if ack_task is not None:
+            await ack_task
+    finally:
+        await action_executor.drain()
+        await db.close()
+        await modlog.close()
+        await bot.session.close()
+
+
+async def feed_local(update: Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        print(f"Update error: {e}")
+
+
+async def poll_updates(feed):
+    offset = await asyncio.to_thread(db.storage.load_state, "update_offset")
+    allowed_updates = dp.resolve_used_update_types()
+    backoff = Backoff()
+    inflight = set()
+
+    def dispatch(update: Update):
+        task = asyncio.ensure_future(feed(update))
+        inflight.add(task)
+        task.add_done_callback(lambda _: finish(task, update.update_id))
+
+    def finish(task, update_id: int):
+        inflight.discard(task)
+        if not task.cancelled():
+            db.schedule(("pending_update", update_id), None)
+
+    for data in await asyncio.to_thread(db.storage.load_pending_updates):
+        dispatch(Update.model_validate_json(data, context={"bot": bot}))
+    while True:
+        if len(inflight) >= POLLING_MAX_INFLIGHT:
+            await asyncio.wait(set(inflight), return_when=asyncio.FIRST_COMPLETED)
+            continue
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                limit=POLLING_LIMIT,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=allowed_updates,
+                request_timeout=POLLING_TIMEOUT + 30
+            )
+        except Exception as e:
+            delay = backoff.next()
+            print(f"Polling error: {e}, повтор через {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        backoff.reset()
+        if not updates:
+            continue
+        for update in updates:
+            if offset is None or update.update_id >= offset:
+                db.schedule(("pending_update", update.update_id), update.model_dump_json(exclude_none=True, by_alias=True))
+                dispatch(update)
+        offset = updates[-1].update_id + 1
+        db.schedule(("state", "update_offset"), offset)
+        while not await db.flush():
+            await asyncio.sleep(backoff.next())
+        backoff.reset()
+
+
+async def main():
+    global bot
+    bot = create_bot()
+    setup_dispatcher()
+    print("Бот запускается....")
+    shards = ShardRouter() if SHARDS > 1 else None
+    if shards:
+        shards.start()
+        startup.ready = True
+    else:
+        await startup.critical()
+        startup.start_warmup()
+    if METRICS_PORT:
+        await metrics.serve()
+    backoff = Backoff()
+    try:
+        while True:
+            try:
+                me = await get_bot_user()
+                print(f"Бот @{me.username} запущен!")
+                if UPDATE_MODE == "webhook":
+                    await WebhookServer(feed=shards.feed if shards else None).serve(on_start=backoff.reset)
+                else:
+                    await bot.delete_webhook(drop_pending_updates=False)
+                    backoff.reset()
+                    await poll_updates(shards.feed if shards else feed_local)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                delay = backoff.next()
+                print(f"Error: {e}, повтор через {delay:.2f}s")
+                await asyncio.sleep(delay)
+    finally:
+        if shards:
+            await shards.stop()
+        await action_executor.drain()
+        await db.close()
+        await modlog.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+
+    asyncio.run(main())